@@ -2,7 +2,7 @@
 # HelperPro.py
 # Version: ArcPro / Python 3+
 # Creation Date: 2020-07-06
-# Last Edit: 2020-11-06
+# Last Edit: 2026-10-15
 # Creator:  Kirsten R. Hazler
 
 # Summary:
@@ -17,6 +17,7 @@ import traceback
 import time
 import numpy
 import math
+import uuid
 from datetime import datetime as datetime 
 
 try:
@@ -36,6 +37,9 @@ arcpy.env.overwriteOutput = True
 print('Using python interpreter version: ' + str(sys.version))
 pyvers = sys.version_info.major
 
+# Field names by dataset, filled by listFieldNames to avoid repeated metadata reads
+fieldCache = {}
+
 
 def getScratchMsg(scratchGDB):
    """Prints message informing user of where scratch output will be written"""
@@ -522,6 +526,33 @@ def ProjectToMatch_ras(in_Data, in_Template, out_Data, resampleType = "NEAREST",
          print('Applying an appropriate geographic transformation...')
       arcpy.ProjectRaster_management (in_Data, out_Data, sr_Out, resampleType, cellSize, geoTrans)
       return out_Data
+
+def AlignToMatch_ras(in_Data, in_Template, out_Data, resampleType = "NEAREST"):
+   '''Check if input raster has the same cell size, coordinate system, and cell alignment as the template raster (see checkAlignment).
+   If not, reproject and/or resample input to match template, limited to the template extent, so that the two can be read together block by block.
+   Parameters:
+   in_Data = input raster to be aligned
+   in_Template = raster used to determine desired spatial reference, cell size, cell alignment, and extent
+   out_Data = output raster resulting from resampling
+   resampleType = type of resampling to use (NEAREST, MAJORITY, BILINEAR, or CUBIC)
+   '''
+   
+   issue = checkAlignment(in_Data, in_Template)
+   if issue is None:
+      print('Input and template rasters are already aligned. No need to resample.')
+      return in_Data
+   
+   print('Aligning input raster to match template (%s)...' %issue)
+   t = Raster(in_Template)
+   cellSize = "%s %s" %(t.meanCellWidth, t.meanCellHeight)
+   (sr_In, sr_Out, reproject, transform, geoTrans) = CompareSpatialRef(in_Data, in_Template)
+   sameSR = sr_In.factoryCode == sr_Out.factoryCode and (sr_Out.factoryCode != 0 or sr_In.name == sr_Out.name)
+   with arcpy.EnvManager(snapRaster = t, extent = t.extent, parallelProcessingFactor = "100%"):
+      if sameSR:
+         arcpy.management.Resample(in_Data, out_Data, cellSize, resampleType)
+      else:
+         arcpy.management.ProjectRaster(in_Data, out_Data, sr_Out, resampleType, cellSize, geoTrans)
+   return out_Data
  
 def Downscale_ras(in_Raster, in_Snap, out_Raster, resType = "BILINEAR", in_clpShp = "NONE"):
    '''Converts a lower resolution raster to one of higher resolution to match the cell size and alignment of the specified snap raster.
@@ -557,14 +588,16 @@ def Downscale_ras(in_Raster, in_Snap, out_Raster, resType = "BILINEAR", in_clpSh
       arcpy.management.Clip(in_Raster, rect, clpRast, in_clpShp, "", "ClippingGeometry", "NO_MAINTAIN_EXTENT")
    
    resRast = scratchGDB + os.sep + "resRast"
-   tmpRast = ProjectToMatch_ras(clpRast, in_Snap, resRast, resType, cellSize)
-   
-   if tmpRast == clpRast:
-      # If no re-projection occurred...
-      print("Resampling...")
-      arcpy.management.Resample(clpRast, resRast, cellSize, resType)
-   else:
-      pass
+   # Both ProjectRaster and Resample honor the parallel processing factor; use all cores for the resampling
+   with arcpy.EnvManager(parallelProcessingFactor = "100%"):
+      tmpRast = ProjectToMatch_ras(clpRast, in_Snap, resRast, resType, cellSize)
+      
+      if tmpRast == clpRast:
+         # If no re-projection occurred...
+         print("Resampling...")
+         arcpy.management.Resample(clpRast, resRast, cellSize, resType)
+      else:
+         pass
 
    print("Finalizing output and saving...")
    finRast = Con(in_Snap, resRast)
@@ -654,7 +687,20 @@ def interpPoints(in_Points, valFld, in_Snap, out_Raster, in_clpShp = "NONE", int
    ds = GetElapsedTime (t0, t1)
    print("Completed interpolation function. Time elapsed: %s" % ds)
 
-def PolyToRaster(in_Poly, in_Fld, in_Snap, out_Rast):
+def procEnv(procMask, **kwargs):
+   '''Returns an arcpy.EnvManager that sets the mask, extent, snap raster, and cell size to match a processing mask raster, for use in a "with" statement. The previous settings are restored at the end of the "with" block, so they do not carry over into later function calls.
+   
+   Parameters:
+   - procMask: Mask raster used to define the processing area, cell size, and alignment
+   - kwargs: Additional (or overriding) environment settings. Set a setting to None to leave it unchanged.
+   '''
+   envs = {"mask": procMask, "extent": procMask, "snapRaster": procMask, "cellSize": procMask}
+   envs.update(kwargs)
+   envs = dict([(k, v) for (k, v) in envs.items() if v is not None])
+   return arcpy.EnvManager(**envs)
+
+
+def PolyToRaster(in_Poly, in_Fld, in_Snap, out_Rast, scratchGDB = "in_memory"):
    '''Converts polygons to raster based on specified field.
    
    Parameters:
@@ -662,28 +708,181 @@ def PolyToRaster(in_Poly, in_Fld, in_Snap, out_Rast):
    - in_Fld: field in feature class used to determine raster values
    - in_Snap: input raster used to specify output coordinate system, processing extent, cell size, and alignment
    - out_Rast: output raster
+   - scratchGDB: workspace for the reprojected polygons, if reprojection is needed. Defaults to memory; specify a geodatabase on disk for very large feature classes.
    '''
    # Set overwrite to be true         
    arcpy.env.overwriteOutput = True
    
-   # Specify scratch location
-   scratchGDB = arcpy.env.scratchGDB
-   
    # Set some output and environment variables
    out_Poly = scratchGDB + os.sep + "polyPrj"
-   arcpy.env.snapRaster = in_Snap
-   arcpy.env.extent = in_Snap
-   arcpy.env.mask = in_Snap   # This shouldn't be necessary in this function.
+   with procEnv(in_Snap, cellSize = None):
    
-   # Re-project polygons, if necessary
-   out_Poly = ProjectToMatch_vec(in_Poly, in_Snap, out_Poly, copy = 0)
+      # Re-project polygons, if necessary
+      out_Poly = ProjectToMatch_vec(in_Poly, in_Snap, out_Poly, copy = 0)
       
-   # Convert to raster
-   print("Rasterizing polygons...")
-   arcpy.PolygonToRaster_conversion (out_Poly, in_Fld, out_Rast, "MAXIMUM_COMBINED_AREA", 'None', in_Snap)
+      # Convert to raster
+      print("Rasterizing polygons...")
+      arcpy.PolygonToRaster_conversion (out_Poly, in_Fld, out_Rast, "MAXIMUM_COMBINED_AREA", 'None', in_Snap)
+   
+      # Cleanup
+      if scratchGDB == "in_memory" and out_Poly != in_Poly:
+         garbagePickup([out_Poly])
+   
+      print("Rasterization complete.")
+      return out_Rast
+
+
+def checkAlignment(in_Raster, in_Template):
+   '''Checks whether a raster has the same cell size, coordinate system, and cell alignment as a template raster, so that cells at the same coordinates can be read together. Returns None if so, or a description of the first mismatch found.
+
+   Parameters:
+   - in_Raster: raster to be checked
+   - in_Template: template raster
+   '''
+   r = in_Raster if isinstance(in_Raster, Raster) else Raster(in_Raster)
+   t = in_Template if isinstance(in_Template, Raster) else Raster(in_Template)
+   cw = t.meanCellWidth
+   ch = t.meanCellHeight
+   if not (math.isclose(r.meanCellWidth, cw, rel_tol = 1e-6) and math.isclose(r.meanCellHeight, ch, rel_tol = 1e-6)):
+      return "cell size %s x %s does not match %s x %s" %(r.meanCellWidth, r.meanCellHeight, cw, ch)
+   srR = r.spatialReference
+   srT = t.spatialReference
+   if srR.factoryCode != srT.factoryCode or (srT.factoryCode == 0 and srR.name != srT.name):
+      return "coordinate system %s does not match %s" %(srR.name, srT.name)
+   for (offset, size) in ((r.extent.XMin - t.extent.XMin, cw), (r.extent.YMin - t.extent.YMin, ch)):
+      shift = offset/size - round(offset/size)
+      if abs(shift) > 0.001:
+         return "cell origin is offset by %s of a cell" %round(shift, 3)
+   return None
+
+
+# NoData values used to read integer rasters that have none defined, by pixel type. Integer arrays cannot hold NaN.
+intNoData = {"U1": 255, "U2": 255, "U4": 255, "U8": 255, "S8": -128, "U16": 65535, "S16": -32768, "U32": 4294967295, "S32": -2147483648}
+
+
+def IterBlocks(in_Rasters, blockSize = 4096, noData = numpy.nan, dtype = numpy.float32):
+   '''Reads one or more rasters block by block, so that large rasters can be processed without reading them into memory all at once. For each block, yields a tuple of the block's lower left corner and a list of arrays, one per input raster.
+
+   Parameters:
+   - in_Rasters: input raster, or list of input rasters. The first raster determines the extent and blocks read; any others must have the same cell size, coordinate system, and alignment (a ValueError is raised otherwise). Cells outside their extent are read as NoData.
+   - blockSize: maximum number of rows and columns in a block
+   - noData: value assigned to NoData cells in the arrays
+   - dtype: data type of the arrays
+   '''
+   if type(in_Rasters) != list:
+      in_Rasters = [in_Rasters]
+   in_Rasters = [r if isinstance(r, Raster) else Raster(r) for r in in_Rasters]
+   t = in_Rasters[0]
+   for r in in_Rasters[1:]:
+      issue = checkAlignment(r, t)
+      if issue is not None:
+         raise ValueError("Raster `%s` is not aligned with `%s`: %s." %(r, t, issue))
+   
+   # Integer rasters are read with an integer NoData value, which is replaced with NaN after conversion
+   readNoData = []
+   for r in in_Rasters:
+      if r.isInteger and isinstance(noData, float) and math.isnan(noData):
+         if r.noDataValue is None:
+            readNoData.append(intNoData[r.pixelType])
+         else:
+            readNoData.append(int(r.noDataValue))
+      else:
+         readNoData.append(None)
    
-   print("Rasterization complete.")
-   return out_Rast
+   cw = t.meanCellWidth
+   ch = t.meanCellHeight
+   for row in range(0, t.height, blockSize):
+      nrows = min(blockSize, t.height - row)
+      for col in range(0, t.width, blockSize):
+         ncols = min(blockSize, t.width - col)
+         lowerLeft = arcpy.Point(t.extent.XMin + col*cw, t.extent.YMax - (row + nrows)*ch)
+         arrs = []
+         for (r, nd) in zip(in_Rasters, readNoData):
+            if nd is None:
+               a = arcpy.RasterToNumPyArray(r, lowerLeft, ncols, nrows, noData).astype(dtype, copy = False)
+            else:
+               a = arcpy.RasterToNumPyArray(r, lowerLeft, ncols, nrows, nd)
+               isNull = (a == nd)
+               a = a.astype(dtype)
+               a[isNull] = noData
+            arrs.append(a)
+         yield (lowerLeft, arrs)
+
+
+# NumPy data types and the corresponding pixel types for MosaicToNewRaster
+pixelTypes = {"uint8": "8_BIT_UNSIGNED", "int8": "8_BIT_SIGNED", "uint16": "16_BIT_UNSIGNED", "int16": "16_BIT_SIGNED", "uint32": "32_BIT_UNSIGNED", "int32": "32_BIT_SIGNED", "float32": "32_BIT_FLOAT", "float64": "64_BIT"}
+
+# Pixel types reported by arcpy.Describe and the corresponding pixel types for MosaicToNewRaster
+describePixelTypes = {"U1": "1_BIT", "U2": "2_BIT", "U4": "4_BIT", "U8": "8_BIT_UNSIGNED", "S8": "8_BIT_SIGNED", "U16": "16_BIT_UNSIGNED", "S16": "16_BIT_SIGNED", "U32": "32_BIT_UNSIGNED", "S32": "32_BIT_SIGNED", "F32": "32_BIT_FLOAT", "F64": "64_BIT"}
+
+
+def BlockApply(in_Rasters, kernel, out_Rasters, noData = -9999, blockSize = 4096, dtype = numpy.float32):
+   '''Applies a function to one or more rasters block by block, and saves the result(s). Each block is read, processed, and written to a temporary raster before the next block is read, and the blocks are then mosaicked into the output. This keeps memory use bounded regardless of raster size. The function must be cell-by-cell (e.g., no neighborhood or whole-raster statistics).
+
+   Parameters:
+   - in_Rasters: input raster, or list of input rasters, read as float arrays (see dtype) with NaN for NoData. The first raster determines the output extent, cell size, and coordinate system; any others must have the same cell size, coordinate system, and alignment (a ValueError is raised otherwise).
+   - kernel: function taking one array per input raster, and returning the output array (or a list of arrays, one per output raster)
+   - out_Rasters: output raster, or list of output rasters
+   - noData: value written as NoData in the outputs (or a list of values, one per output raster). For floating point outputs, NaN is also written as NoData.
+   - blockSize: maximum number of rows and columns in a block
+   - dtype: float data type of the input arrays. Use numpy.float64 for integer rasters with values too large for 32-bit floats to hold exactly (above about 16 million, e.g., object IDs).
+   '''
+   if type(in_Rasters) != list:
+      in_Rasters = [in_Rasters]
+   single = type(out_Rasters) != list
+   if single:
+      out_Rasters = [out_Rasters]
+   if type(noData) != list:
+      noData = [noData]*len(out_Rasters)
+   t = in_Rasters[0] if isinstance(in_Rasters[0], Raster) else Raster(in_Rasters[0])
+   in_Rasters = [t] + in_Rasters[1:]
+   scratchFolder = arcpy.env.scratchFolder
+   # Block names are unique to this call, so concurrent processes or nested calls sharing the scratch folder do not overwrite each other's blocks
+   tag = uuid.uuid4().hex
+   
+   blocks = [[] for o in out_Rasters]
+   dtypes = [None for o in out_Rasters]
+   n = 0
+   for (lowerLeft, arrs) in IterBlocks(in_Rasters, blockSize, dtype = dtype):
+      outArrs = kernel(*arrs)
+      if single:
+         outArrs = [outArrs]
+      for i in range(len(out_Rasters)):
+         a = outArrs[i]
+         if a.dtype.kind == 'f':
+            a = numpy.where(numpy.isnan(a), noData[i], a)
+         dtypes[i] = a.dtype.name
+         blk = scratchFolder + os.sep + "blk%s_%s_%s.tif" %(tag, i, n)
+         arcpy.NumPyArrayToRaster(a, lowerLeft, t.meanCellWidth, t.meanCellHeight, noData[i]).save(blk)
+         blocks[i].append(blk)
+      n += 1
+   
+   # Both output paths are pinned to the template grid and extent, regardless of the caller's environment settings
+   for i in range(len(out_Rasters)):
+      out = out_Rasters[i]
+      with arcpy.EnvManager(snapRaster = t, extent = t.extent):
+         if len(blocks[i]) == 1:
+            arcpy.management.CopyRaster(blocks[i][0], out)
+            arcpy.management.DefineProjection(out, t.spatialReference)
+         else:
+            arcpy.management.MosaicToNewRaster(blocks[i], os.path.dirname(out), os.path.basename(out), t.spatialReference, pixelTypes[dtypes[i]], t.meanCellWidth, 1, "FIRST")
+      garbagePickup(blocks[i])
+   
+   if single:
+      return out_Rasters[0]
+   return out_Rasters
+
+
+def listFieldNames(in_Table, refresh = False):
+   '''Returns the set of field names in a table or feature class. Results are cached by dataset path, so repeated checks on the same dataset do not each read its metadata. Functions that add fields to a cached dataset should add the new names to the returned set.
+   
+   Parameters:
+   - in_Table: input table or feature class
+   - refresh: if True, re-reads the field names even if they are cached
+   '''
+   if refresh or in_Table not in fieldCache:
+      fieldCache[in_Table] = set([f.name for f in arcpy.ListFields(in_Table)])
+   return fieldCache[in_Table]
 
 
 def JoinFast(ToTab, ToFld, FromTab, FromFld, JoinFlds):
@@ -693,6 +892,7 @@ def JoinFast(ToTab, ToFld, FromTab, FromFld, JoinFlds):
    Adapted from: https://gis.stackexchange.com/questions/207943/speeding-up-join-in-arcpy
 
    Note: will remove existing fields from ToTab with the names of JoinFlds. This differs from JoinField_management.
+   Note: each table is read once, sequentially, and matches are looked up in the dictionary, so attribute indexes on the key fields are not needed.
 
    ToTab = The table to which fields will be added
    ToFld = The key field in ToTab, used to match records in FromTab
@@ -717,9 +917,9 @@ def JoinFast(ToTab, ToFld, FromTab, FromFld, JoinFlds):
          joinval = row[0]
          joindict[joinval] = [row[a] for a in r]
    del row, rows
-   tFlds = [a.name for a in arcpy.ListFields(ToTab)]
+   tFlds = listFieldNames(ToTab)
    # Add fields
-   for j in JoinFlds:
+   for j in flds:
       ft = [a.type for a in flds_info if a.name == j][0]
       if j in tFlds:
          arcpy.DeleteField_management(ToTab, j)
@@ -729,6 +929,7 @@ def JoinFast(ToTab, ToFld, FromTab, FromFld, JoinFlds):
          arcpy.AddField_management(ToTab, j, "LONG")
       else:
          arcpy.AddField_management(ToTab, j, "DOUBLE")
+      tFlds.add(j)
    # Do updates
    with arcpy.da.UpdateCursor(ToTab, [ToFld] + flds) as recs:
       for rec in recs:
@@ -2,7 +2,7 @@
 # WtrshdImpact_Functions.py
 # Version: ArcPro / Python 3+
 # Creation Date: 2020-07-06
-# Last Edit: 2022-05-27
+# Last Edit: 2026-10-15
 # Creator: Kirsten R. Hazler
 #
 # Summary: Functions to produce the Virginia ConservationVision Watershed Impact Model
@@ -18,31 +18,143 @@
 # Import modules
 import HelperPro
 from HelperPro import *
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+# Don't build pyramids or statistics every time a raster is saved. Most outputs here are intermediates whose statistics are never used; pyramids are built explicitly for outputs that need them, and statistics are built for the final score rasters.
+arcpy.env.pyramid = "NONE"
+arcpy.env.rasterStatistics = "NONE"
+finalStats = "STATISTICS 1 1"
+
+# Slope thresholds for the TRUNCLIN transformation in SlopeTrans (1 and 30 degrees), by slope units
+truncSlopes = {"DEGREES": (1.0, 30.0), 
+               "PERCENT": (100*math.tan(math.radians(1.0)), 100*math.tan(math.radians(30.0)))}
+
+# Slope at which the RUSLE S-factor equation changes (9 percent), by slope units
+rusleInflect = {"DEGREES": math.degrees(math.atan(9.0/100)), 
+                "PERCENT": 9.0}
+
+deg2rad = math.pi/180.0
+
+# Numeric values for hydrologic soil groups, per OpenNSPECT guidance
+hydroGrpNums = {"A": 1, "B": 2, "C": 3, "D": 4}
+
+# K-factor assigned to map units with no K-factor, per the OpenNSPECT Technical Guide
+kFactorDefault = 0.3
+
+# Runoff curve numbers for hydrologic soil groups (A, B, C, D), by NLCD land cover code, per Table 1, page 6 of the OpenNSPECT Technical Guide. Code 32 (unconsolidated shore) is from CCAP.
+curvNumTable = {
+   11: (0, 0, 0, 0),
+   21: (49, 69, 79, 84),
+   22: (61, 75, 83, 87),
+   23: (77, 85, 90, 92),
+   24: (89, 92, 94, 95),
+   31: (77, 86, 91, 94),
+   32: (0, 0, 0, 0),
+   41: (30, 55, 70, 77),
+   42: (30, 55, 70, 77),
+   43: (30, 55, 70, 77),
+   52: (30, 48, 65, 73),
+   71: (30, 58, 71, 78),
+   81: (39, 61, 74, 80),
+   82: (67, 78, 85, 89),
+   90: (0, 0, 0, 0),
+   95: (0, 0, 0, 0)}
+
+# Curve number lookup table indexed by [hydroGroup, landCoverCode]. Curve numbers range from 0 to 100, so they are stored as 8-bit unsigned integers. Row 0 (invalid hydro group) is NoData (curvNumNoData); land cover codes not in the table get 0. Column 100 is not a table code; codes outside 0-99 are looked up there, so they also get 0.
+curvNumNoData = 255
+curvNumLUT = numpy.zeros((5, 101), dtype=numpy.uint8)
+curvNumLUT[0, :] = curvNumNoData
+for code, cns in curvNumTable.items():
+   curvNumLUT[1:, code] = cns
 
 ### General Functions
-def getTruncVals(in_Raster, in_Mask = "NONE", numSD = 3):
+def getTruncVals(in_Raster, in_Mask = "NONE", numSD = 3, skipFactor = 10):
    '''Based on raster statistics, calculates lower and upper cutoff values to be used for rescaling purposes.
    
    Parameters:
    in_Raster: The input raster to be analyzed
-   in_Mask: Mask raster used to define the portion of the input raster to be analyzed
+   in_Mask: Mask raster used to define the portion of the input raster to be analyzed. Must have the same cell size and alignment as the input raster. Alternatively, "NONZERO" analyzes only the nonzero cells of the input raster, without a separate mask raster.
    numSD: The number of standard deviations used to determine the cutoff values
+   skipFactor: If there is no mask and the raster has no statistics, statistics are calculated using every nth row and column
+   
+   If there is no mask, the statistics stored with the raster are used. If it has none, they are calculated from a sample of cells (every nth row and column, as set by skipFactor), read block by block; the sample statistics are not saved with the input raster. For the 3-standard-deviation cutoffs, a sample is as good as a full scan.
+   
+   If there is a mask, the raster and mask are read once, block by block, and the minimum, maximum, mean, and standard deviation are all calculated from that single read.
    '''
    
-   try:
-      r = Con(Raster(in_Mask), Raster(in_Raster))
-   except:
-      r = Raster(in_Raster)
-
-   rMin = r.minimum
-   rMax = r.maximum
-   rMean = r.mean
-   rSD = r.standardDeviation
+   stats = None
+   if type(in_Mask) == str and in_Mask == "NONE":
+      statTypes = ("MINIMUM", "MAXIMUM", "MEAN", "STD")
+      try:
+         stats = [float(arcpy.GetRasterProperties_management(in_Raster, t).getOutput(0)) for t in statTypes]
+         (rMin, rMax, rMean, rSD) = stats
+      except:
+         print("Calculating statistics from a sample of cells...")
+   
+   if stats is None:
+      # Read the raster and mask block by block, accumulating the sums needed for all statistics in the same pass
+      n = 0
+      rSum = 0.0
+      rSumSq = 0.0
+      rMin = float("inf")
+      rMax = float("-inf")
+      if type(in_Mask) == str and in_Mask == "NONE":
+         # Sample every nth row and column of each block; the 1x1 "mask" of ones applies to every sampled cell
+         blocks = ((lowerLeft, (a[::skipFactor, ::skipFactor], numpy.ones((1, 1), dtype = numpy.float32))) for (lowerLeft, (a,)) in IterBlocks([in_Raster]))
+      elif type(in_Mask) == str and in_Mask == "NONZERO":
+         blocks = ((lowerLeft, (a, a)) for (lowerLeft, (a,)) in IterBlocks([in_Raster]))
+      else:
+         blocks = IterBlocks([in_Raster, in_Mask])
+      for (lowerLeft, (a, m)) in blocks:
+         a = a[(m != 0) & ~numpy.isnan(m) & ~numpy.isnan(a)].astype(numpy.float64)
+         if a.size == 0:
+            continue
+         n += a.size
+         rSum += a.sum()
+         rSumSq += numpy.dot(a, a)
+         rMin = min(rMin, a.min())
+         rMax = max(rMax, a.max())
+      if n == 0:
+         raise ValueError("Raster `" + str(in_Raster) + "` has no data cells within mask `" + str(in_Mask) + "`.")
+      rMean = rSum/n
+      rSD = math.sqrt(max(rSumSq/n - rMean**2, 0))
+   
    TruncMin = max(rMin,(rMean - numSD*rSD))
    TruncMax = min(rMax,(rMean + numSD*rSD))
    
    return (TruncMin, TruncMax)
 
+def rescaleLinear(in_Array, inMin, inMax, outMin = 1, outMax = 100):
+   '''Linearly rescales array values from the range [inMin, inMax] to the range [outMin, outMax]. Values outside the input range are set to the nearest end of the output range. This is equivalent to RescaleByFunction with TfLinear(inMin, outMin, inMax, outMax), applied to a NumPy array.
+   
+   Parameters:
+   in_Array: Array of values to be rescaled
+   inMin: Input value assigned the minimum output value
+   inMax: Input value assigned the maximum output value
+   outMin: Minimum output value
+   outMax: Maximum output value
+   '''
+   scale = (outMax - outMin)/(inMax - inMin)
+   out = (in_Array - inMin)*scale
+   out += outMin
+   return numpy.clip(out, min(outMin, outMax), max(outMin, outMax), out = out)
+
+
+def meanScore(a, b):
+   '''Returns the mean of two score arrays, ignoring NaN (NoData) in either input. This is equivalent to CellStatistics MEAN with the DATA option, for two inputs.
+   
+   Parameters:
+   a, b: Arrays of scores, of the same shape
+   '''
+   score = a + b
+   score *= 0.5
+   aNull = numpy.isnan(a)
+   score[aNull] = b[aNull]
+   bNull = numpy.isnan(b)
+   score[bNull] = a[bNull]
+   return score
+
 
 ### Functions for preparing gSSURGO data
 def HydroGrp_vec(in_GDB):
@@ -91,40 +203,30 @@ def HydroGrp_vec(in_GDB):
    print("Working on %s" %bname) 
    
    # Process: Join Hydrologic Group value to MUPOLYGON
-   # First check if field exists (due to prior processing) and delete if so
-   fldList = arcpy.ListFields(mupolygon) 
-   fldNames = [f.name for f in fldList]
-   if hydroFld in fldNames:
-      print("Deleting existing hydrologic group field in MUPOLYGON...")
-      arcpy.DeleteField_management (mupolygon, hydroFld)
+   # JoinFast replaces the field if it exists (due to prior processing)
    print("Joining Hydrologic Group field to MUPOLYGON...")
-   arcpy.JoinField_management(mupolygon, "MUKEY", hydroTab, "MUKEY", hydroFld)
+   JoinFast(mupolygon, "MUKEY", hydroTab, "MUKEY", hydroFld)
    
    # Create and calculate a field in MUPOLYGON to store numeric version of hydrologic group, and calculate
-   print("Adding numeric field for hydrologic group...")
-   arcpy.AddField_management(mupolygon, "HydroGrpNum", "SHORT")
-   
+   mupolyFlds = listFieldNames(mupolygon)
+   if "HydroGrpNum" not in mupolyFlds:
+      print("Adding numeric field for hydrologic group...")
+      arcpy.AddField_management(mupolygon, "HydroGrpNum", "SHORT")
+      mupolyFlds.add("HydroGrpNum")
+   
+   # There are only a handful of distinct codes, so each is parsed once and looked up thereafter. 
+   # Rows already holding the right number (e.g., from a prior run) are not rewritten.
    print("Calculating HydroGrpNum field...")
-   codeblock = '''def grpNum(fld):
-      d = dict()
-      d["A"] = 1
-      d["B"] = 2
-      d["C"] = 3
-      d["D"] = 4
-      
-      if fld == None:
-         key = "D"
-      elif len(fld) > 1:
-         key = fld[-1]
-      else:
-         key = fld   
-      
-      val = d[key]
-      
-      return val
-   '''
-   expression = "grpNum(!%s!)" %hydroFld
-   arcpy.CalculateField_management (mupolygon, "HydroGrpNum", expression, 'PYTHON', codeblock)
+   codeNums = {None: hydroGrpNums["D"], "": hydroGrpNums["D"]}
+   with arcpy.da.UpdateCursor(mupolygon, [hydroFld, "HydroGrpNum"]) as curs:
+      for row in curs:
+         code = row[0]
+         if code not in codeNums:
+            codeNums[code] = hydroGrpNums[code[-1]]
+         num = codeNums[code]
+         if row[1] != num:
+            row[1] = num
+            curs.updateRow(row)
    
    print("Mission complete for %s." %bname)
 
@@ -176,37 +278,62 @@ def Kfactor_vec(in_GDB):
    # For some reason, the K-factor field created by the SSURGO toolbox is a string. 
    # Convert to double since this is needed for correct rasterization later.
    print("Converting string to double...")
-   arcpy.AddField_management(kfactTab, "kFactor", "DOUBLE")
-   expression = "float(!%s!)" %kfactFld
-   arcpy.CalculateField_management (kfactTab, "kFactor", expression, 'PYTHON')
+   kfactFlds = listFieldNames(kfactTab)
+   if "kFactor" not in kfactFlds:
+      arcpy.AddField_management(kfactTab, "kFactor", "DOUBLE")
+      kfactFlds.add("kFactor")
+   with arcpy.da.UpdateCursor(kfactTab, [kfactFld, "kFactor"]) as curs:
+      for row in curs:
+         if row[0] in (None, ""):
+            row[1] = None
+         else:
+            row[1] = float(row[0])
+         curs.updateRow(row)
    kfactFld = "kFactor"
    
    # Process: Join K-factor value to MUPOLYGON
-   # First check if field exists (due to prior processing) and delete if so
-   fldList = arcpy.ListFields(mupolygon) 
-   fldNames = [f.name for f in fldList]
-   if kfactFld in fldNames:
-      print("Deleting existing K-factor field in MUPOLYGON...")
-      arcpy.DeleteField_management (mupolygon, kfactFld)
+   # JoinFast replaces the field if it exists (due to prior processing)
    print("Joining K-factor field to MUPOLYGON...")
-   arcpy.JoinField_management(mupolygon, "MUKEY", kfactTab, "MUKEY", kfactFld)
+   JoinFast(mupolygon, "MUKEY", kfactTab, "MUKEY", kfactFld)
    
    # Replace nulls in the K-factor field with the value 0.30, per the OpenNSPECT Technical Guide.
    print("Replacing nulls in K-factor field...")
-   codeblock = '''def replaceNulls(fld):
-      if fld == None:
-         val = 0.3
-      else:
-         val = fld
-      return val
-   '''
-   expression = "replaceNulls(!%s!)" %kfactFld
-   arcpy.CalculateField_management (mupolygon, kfactFld, expression, 'PYTHON', codeblock)
+   with arcpy.da.UpdateCursor(mupolygon, [kfactFld]) as curs:
+      for row in curs:
+         if row[0] == None:
+            row[0] = kFactorDefault
+            curs.updateRow(row)
    
    print("Mission complete for %s." %bname)
 
    return
 
+def rasterizeMUPOLYGON(in_GDB, in_Fld, in_Snap, scratchFolder):
+   '''Rasterizes the MUPOLYGON feature class from a single gSSURGO geodatabase. Used by SSURGOtoRaster, which runs it in a separate process for each geodatabase. Each call uses its own scratch workspace, to avoid lock contention between processes.
+   
+   Parameters:
+   in_GDB: gSSURGO geodatabase containing added attributes
+   in_Fld: field in MUPOLYGON feature class used to determine output raster values
+   in_Snap: Input raster that determines output coordinate system, processing extent, cell size, and alignment
+   scratchFolder: Folder in which to create the scratch workspace
+   
+   Returns the path to the output raster, or None if rasterization failed.
+   '''
+   bname = os.path.basename(in_GDB).replace(".gdb","")
+   try:
+      print("Working on %s" %bname)
+      scratchWS = os.path.join(scratchFolder, "ssurgo_%s" %bname)
+      os.makedirs(scratchWS, exist_ok = True)
+      arcpy.env.scratchWorkspace = scratchWS
+      inPoly = in_GDB + os.sep + "MUPOLYGON"
+      # The reprojected polygons stay in memory, but the state raster must be written to disk so the parent process can mosaic it.
+      outRast = arcpy.env.scratchGDB + os.sep + bname
+      PolyToRaster(inPoly, in_Fld, in_Snap, outRast)
+      return outRast
+   except:
+      print("Failed to rasterize %s" %bname)
+      return None
+
 def SSURGOtoRaster(in_gdbList, in_Fld, in_Snap, out_Raster):
    '''From one or more gSSURGO geodatabases, creates a raster representing values from a specified field in the MUPOLYGON feature class. 
    
@@ -215,32 +342,34 @@ def SSURGOtoRaster(in_gdbList, in_Fld, in_Snap, out_Raster):
    in_Fld: field in MUPOLYGON feature class used to determine output raster values
    in_Snap: Input raster that determines output coordinate system, processing extent, cell size, and alignment
    out_Raster: Output raster 
+   
+   The geodatabases are rasterized in parallel, one process per geodatabase (up to the number of CPUs).
    '''
    
    # Set overwrite to be true         
    arcpy.env.overwriteOutput = True
    
    # Specify scratch location
-   scratchGDB = arcpy.env.scratchGDB
-   
-   # Empty list to contain raster paths
-   rasterList = []
-   
-   # Work through loop converting polygons to rasters
-   for gdb in in_gdbList:
-      try:
-         inPoly = gdb + os.sep + "MUPOLYGON"
-         bname = os.path.basename(gdb).replace(".gdb","")
-         print("Working on %s" %bname)
-         outRast = scratchGDB + os.sep + bname
-         PolyToRaster(inPoly, in_Fld, in_Snap, outRast)
-         rasterList.append(outRast)
-      except:
-         print("Failed to rasterize %s" %bname)
-   
+   scratchFolder = arcpy.env.scratchFolder
+   
+   # Convert polygons to rasters in parallel
+   numWorkers = min(len(in_gdbList), os.cpu_count())
+   print("Rasterizing %s geodatabases using %s processes..." %(len(in_gdbList), numWorkers))
+   with ProcessPoolExecutor(max_workers = numWorkers) as ex:
+      results = list(ex.map(rasterizeMUPOLYGON, in_gdbList, repeat(in_Fld), repeat(in_Snap), repeat(scratchFolder)))
+   rasterList = [r for r in results if r is not None]
+   if len(rasterList) == 0:
+      raise RuntimeError("None of the %s geodatabases could be rasterized." %len(in_gdbList))
+   
+   # Mosaic the state rasters. These are (nearly) disjoint, so mosaicking streams far less data than stacking them all with CellStatistics. The MAXIMUM method resolves any overlaps the same way CellStatistics did.
    print("Finalizing output and saving...")
-   finRast = CellStatistics(rasterList, "MAXIMUM", "DATA")
-   finRast.save(out_Raster)
+   pixelType = describePixelTypes[arcpy.Describe(rasterList[0]).pixelType]
+   snap = Raster(in_Snap)
+   with arcpy.EnvManager(snapRaster = in_Snap, extent = in_Snap):
+      arcpy.management.MosaicToNewRaster(rasterList, os.path.dirname(out_Raster), os.path.basename(out_Raster), snap.spatialReference, pixelType, snap.meanCellWidth, 1, "MAXIMUM")
+   
+   # Cleanup
+   garbagePickup(rasterList)
    
    print("Mission complete.")
 
@@ -262,6 +391,8 @@ def SlopeTrans(in_Raster, inputType, transType, out_Trans, out_Slope, zfactor =
    - out_Trans: output raster representing transformed slope
    - out_Slope: output raster representing slope as percent grade (ignored if input is a slope raster)
    - zfactor: Number of ground x,y units in one surface z-unit (ignored if input is a slope raster)
+   
+   NOTE: Deriving slope from elevation is a full neighborhood pass over the DEM. If more than one transformation is needed from the same DEM, run the first from elevation, then use the saved out_Slope raster as the input (inputType = PERCENT) for the rest, so slope is only derived once.
    '''
    
    # Make sure user entered valid parameters, and report what they are.   
@@ -291,9 +422,6 @@ def SlopeTrans(in_Raster, inputType, transType, out_Trans, out_Slope, zfactor =
    # Set overwrite to be true         
    arcpy.env.overwriteOutput = True
    
-   # Set scratch output location
-   scratchGDB = arcpy.env.scratchGDB
-   
    # Identify the slope raster or create it if necessary
    if inputType in ("ELEV", "ELEVATION"):
       print("Calculating slope from elevation...")
@@ -302,44 +430,48 @@ def SlopeTrans(in_Raster, inputType, transType, out_Trans, out_Slope, zfactor =
    else:   
       in_Slope = Raster(in_Raster)
    
-   if transType == "TRUNCLIN":
-   # Set flat and nearly level slopes (LTE 1 degree) to 0. Set extreme slopes (GTE 30 degrees) to 100. Use linear function to scale between those values.
-      minSlope = 1.0
-      maxSlope = 30.0
+   # Define the transformation for a block of slope values. Each transformation is a single fused expression on the array, rather than a chain of map algebra operators that each write an intermediate raster.
+   def sine(s):
       if slopeType == "PERCENT":
-         print("Calculating score...")
-         minSlope = 100*math.tan(minSlope*math.pi/180)
-         maxSlope = 100*math.tan(maxSlope*math.pi/180)
-         outRaster = Con(in_Slope <= minSlope, 0, Con((in_Slope > maxSlope), 100, 100 * (in_Slope - minSlope) / (maxSlope - minSlope)))
+         x = numpy.arctan(s/100)
       else: 
-         print("Calculating score...")
-         outRaster = Con(in_Slope <= minSlope, 0, Con((in_Slope > maxSlope), 100, 100 * (in_Slope - minSlope) / (maxSlope - minSlope)))
+         x = s*deg2rad
+      return numpy.sin(x, out=x)
+   
+   if transType == "TRUNCLIN":
+   # Set flat and nearly level slopes (LTE 1 degree) to 0. Set extreme slopes (GTE 30 degrees) to 100. Use linear function to scale between those values.
+      (minSlope, maxSlope) = truncSlopes[slopeType]
+      # The linear function is 0 at minSlope and 100 at maxSlope, so clamping it gives the thresholds without any branching.
+      def trans(s):
+         return numpy.clip((100/(maxSlope - minSlope))*(s - minSlope), 0, 100)
    
    elif transType == "TRUNCSIN":
-   # Take the sine, multiply by 200, and integerize. Upper values are truncated at 100 (which happens at 30 degrees).
-      if slopeType == "PERCENT":
-         # fixme: Use of Min in these statements was incorrect. Fixed below with intermediate raster procSlope, and Con statement for truncation.
-         print("Converting percent grade to radians and calculating score...")
-         # outRaster = Min(100, Int(0.5 + 200*Sin(ATan(in_Slope/100))))
-         procSlope = Int(0.5 + 200*Sin(ATan(in_Slope/100)))
-      else: 
-         print("Converting degrees to radians and calculating score...")
-         # outRaster = Min(100, Int(0.5 + 200*Sin(in_Slope * math.pi/180.0)))
-         procSlope = Int(0.5 + 200*Sin(in_Slope * math.pi/180.0))
-      outRaster = Con(procSlope, 100, procSlope, "VALUE > 100")
+   # Take the sine, multiply by 200, and round to whole numbers. Upper values are truncated at 100 (which happens at 30 degrees).
+   # The scores are kept as 32-bit floats, in place in a single array; NaN (NoData) passes through, so no null mask or integer cast is needed.
+      def trans(s):
+         procSlope = sine(s)
+         procSlope *= 200
+         procSlope += 0.5
+         numpy.trunc(procSlope, out=procSlope)
+         return numpy.minimum(procSlope, 100, out=procSlope)
+   
    else:
    # Use RUSLE transformation equations
-      inflect = 9.0
-      if slopeType == "PERCENT":
-         print("Converting percent grade to radians and calculating S-factor...")
-         outRaster = Con(in_Slope < inflect, (10.8*(Sin(ATan(in_Slope/100))) + 0.03), (16.8*(Sin(ATan(in_Slope/100))) - 0.50))
-      else: 
-         inflect = math.atan(inflect/100)*180/math.pi
-         print("Converting degrees to radians and calculating S-factor...")
-         outRaster = Con(in_Slope < inflect, (10.8*(Sin(in_Slope * math.pi/180.0)) + 0.03), (16.8*(Sin(in_Slope * math.pi/180.0)) - 0.50))
-      
-   print("Saving output...")
-   outRaster.save(out_Trans)
+      inflect = rusleInflect[slopeType]
+      # Each branch is applied in place to its own cells, so the block needs one mask and no temporary arrays
+      def trans(s):
+         gentle = s < inflect
+         sinSlope = sine(s)
+         numpy.multiply(sinSlope, 10.8, out=sinSlope, where=gentle)
+         numpy.add(sinSlope, 0.03, out=sinSlope, where=gentle)
+         steep = numpy.invert(gentle, out=gentle)
+         numpy.multiply(sinSlope, 16.8, out=sinSlope, where=steep)
+         numpy.subtract(sinSlope, 0.50, out=sinSlope, where=steep)
+         return sinSlope
+   
+   # Process the slope raster block by block, so memory use stays bounded for large rasters
+   print("Calculating and saving output...")
+   BlockApply(in_Slope, trans, out_Trans)
    
    print("Mission complete")
    
@@ -357,25 +489,28 @@ def soilLoss_RKSC(in_Rfactor, in_Kfactor, in_Sfactor, in_Cfactor, out_RKSC):
    
    NOTE: For the C-factor, the Watershed Impact Model uses a constant value (0.7) to get a measure of soil loss under a "worst-case scenario" of bare land. If you want soil loss under existing land cover conditions, first create a C-factor raster based on land cover (see OpenNSPECT documentation), and use that as the input. 
    
-   This functions assumes all inputs are in the same coordinate system and properly aligned with each other.
+   This functions assumes all inputs are in the same coordinate system and properly aligned with each other. The R-factor raster determines the output extent; the other rasters must cover it. The factors are multiplied block by block in a single pass.
    '''
    
    # Set overwrite to be true         
    arcpy.env.overwriteOutput = True
    
-   # Calculate propensity for soil loss by multiplying the factors
-   print("Calculating propensity for soil loss...")
-   R = Raster(in_Rfactor)
-   K = Raster(in_Kfactor)
-   S = Raster(in_Sfactor)
-   try:
-      C = Raster(in_Cfactor)
-   except:
-      C = in_Cfactor
-   RKSC = R*K*S*C
+   # Calculate propensity for soil loss by multiplying the factors, in place in the same array
+   def rksc(R, K, S, C = None):
+      R *= K
+      R *= S
+      if C is None:
+         R *= in_Cfactor
+      else:
+         R *= C
+      return R
+   
+   in_Rasters = [in_Rfactor, in_Kfactor, in_Sfactor]
+   if not isinstance(in_Cfactor, (int, float)):
+      in_Rasters.append(in_Cfactor)
    
-   print("Saving output...")
-   RKSC.save(out_RKSC)
+   print("Calculating and saving propensity for soil loss...")
+   BlockApply(in_Rasters, rksc, out_RKSC)
    
    print("Mission complete.")
 
@@ -389,141 +524,43 @@ def curvNum(in_LC, in_HydroGrp, out_CN):
    - in_HydroGrp: Input raster representing hydrologic groups (integer values must range from 1 = A to 4 = D)
    - out_CN: Output raster representing runoff curve numbers
    
-   Note: If a land cover raster is used, the function modifies the input land cover attribute table, by adding and calculating a new field to store the curve numbers
+   Note: The land cover and hydrologic group rasters must have the same cell size and alignment. The hydrologic group raster determines the output extent. Curve numbers are looked up block by block, in a single pass using the module-level curvNumLUT table, indexed by [hydroGroup, landCoverCode]; land cover codes not in the table (including codes outside 0-99) are assigned 0, and cells where either input is NoData, or with an invalid hydrologic group, are NoData. The output is an 8-bit unsigned integer raster.
    '''
    
    # Set overwrite to be true         
    arcpy.env.overwriteOutput = True
    
-   # Set scratch output location
-   scratchGDB = arcpy.env.scratchGDB
+   def toCodes(a):
+      # Blocks are read as float with NaN for NoData; convert to integer codes, with 0 for NoData
+      return numpy.where(numpy.isnan(a), 0, a).astype(numpy.int32)
    
-   # Initialize empty data dictionaries
-   dictA = dict()
-   dictB = dict()
-   dictC = dict()
-   dictD = dict()
-   m = dict()
-   
-   # Populate dictionary for hydro group A, then append to list
-   dictA[11] = 0
-   dictA[21] = 49
-   dictA[22] = 61
-   dictA[23] = 77
-   dictA[24] = 89
-   dictA[31] = 77
-   dictA[32] = 0
-   dictA[41] = 30
-   dictA[42] = 30
-   dictA[43] = 30
-   dictA[52] = 30
-   dictA[71] = 30
-   dictA[81] = 39
-   dictA[82] = 67
-   dictA[90] = 0
-   dictA[95] = 0
-   m["A"] = dictA
-   
-   # Populate dictionary for hydro group B
-   dictB[11] = 0
-   dictB[21] = 69
-   dictB[22] = 75
-   dictB[23] = 85
-   dictB[24] = 92
-   dictB[31] = 86
-   dictB[32] = 0
-   dictB[41] = 55
-   dictB[42] = 55
-   dictB[43] = 55
-   dictB[52] = 48
-   dictB[71] = 58
-   dictB[81] = 61
-   dictB[82] = 78
-   dictB[90] = 0
-   dictB[95] = 0
-   m["B"] = dictB
-   
-   # Populate dictionary for hydro group C
-   dictC[11] = 0
-   dictC[21] = 79
-   dictC[22] = 83
-   dictC[23] = 90
-   dictC[24] = 94
-   dictC[31] = 91
-   dictC[32] = 0
-   dictC[41] = 70
-   dictC[42] = 70
-   dictC[43] = 70
-   dictC[52] = 65
-   dictC[71] = 71
-   dictC[81] = 74
-   dictC[82] = 85
-   dictC[90] = 0
-   dictC[95] = 0
-   m["C"] = dictC
-   
-   # Populate dictionary for hydro group D
-   dictD[11] = 0
-   dictD[21] = 84
-   dictD[22] = 87
-   dictD[23] = 92
-   dictD[24] = 95
-   dictD[31] = 94
-   dictD[32] = 0
-   dictD[41] = 77
-   dictD[42] = 77
-   dictD[43] = 77
-   dictD[52] = 73
-   dictD[71] = 78
-   dictD[81] = 80
-   dictD[82] = 89
-   dictD[90] = 0
-   dictD[95] = 0
-   m["D"] = dictD
-      
-   hydroGrps = ["A", "B", "C", "D"]
-   in_HydroGrp = Raster(in_HydroGrp)
+   # Look up the curve numbers for a block of cells
+   def cnKernel(hg, lc = None):
+      hydroGrp = toCodes(hg)
+      if lc is None:
+         lc = in_LC
+      else:
+         lcNull = numpy.isnan(lc)
+         lc = toCodes(lc)
+         lc[(lc < 0) | (lc > 99)] = 100
+         hydroGrp[lcNull] = 0
+      hydroGrp[(hydroGrp < 1) | (hydroGrp > 4)] = 0
+      return curvNumLUT[hydroGrp, lc]
    
    if type(in_LC) == str:
-      # Create and calculate curve number fields in the land cover attribute table
-      for grp in hydroGrps:  
-         fldName = "cn_%s" %grp
-         d = m[grp]
-         
-         fldList = arcpy.ListFields(in_LC) 
-         fldNames = [f.name for f in fldList]
-         if fldName in fldNames:
-            print("Deleting existing field %s..." %fldName)
-            arcpy.DeleteField_management (in_LC, fldName)
-         
-         print("Adding field %s..." %fldName)
-         arcpy.AddField_management(in_LC, fldName, "SHORT")
-      
-         print("Calculating field...")
-         codeblock = '''def curvnum(code, dic):
-            try:
-               cn = dic[code]
-            except:
-               cn = 0
-            return cn
-            '''
-         expression = "curvnum(!VALUE!, %s)" %d
-         arcpy.CalculateField_management (in_LC, fldName, expression, 'PYTHON', codeblock)
-      
-      # Create a new raster from the curve number fields, based on soil type
-      print("Creating curve number raster...")
-      outRaster = Con(in_HydroGrp == 1, Lookup(in_LC, "cn_A"), Con(in_HydroGrp == 2, Lookup(in_LC, "cn_B"), Con(in_HydroGrp == 3, Lookup(in_LC, "cn_C"),Con(in_HydroGrp == 4, Lookup(in_LC, "cn_D")))))
-   
+      in_Rasters = [in_HydroGrp, in_LC]
    else:
       # Use the specified land cover constant with soil type to get the curve number
-      outRaster = Con(in_HydroGrp == 1, dictA[in_LC], Con(in_HydroGrp == 2, dictB[in_LC], Con(in_HydroGrp == 3, dictC[in_LC],Con(in_HydroGrp == 4, dictD[in_LC]))))
+      if in_LC not in curvNumTable:
+         raise ValueError("Land cover code %s is not in the curve number table." %in_LC)
+      in_Rasters = [in_HydroGrp]
    
-   print("Saving output...")
-   outRaster.save(out_CN)
+   print("Creating and saving curve number raster...")
+   BlockApply(in_Rasters, cnKernel, out_CN, curvNumNoData)
    
    print("Mission complete.")
 
-def eventRunoff(in_Raster, in_Rain, out_GDB, nameTag, cellArea = 1000000, inputType = "CN", convFact = 1, vol = 0):
+def eventRunoff(in_Raster, in_Rain, out_GDB, nameTag, cellArea = 1000000, inputType = "CN", convFact = 1, vol = 0, ret = 0):
    '''Produces an output raster representing event-based runoff depth in inches. Optionally produces runoff volume as well.
    
    Parameters:
@@ -535,54 +572,77 @@ def eventRunoff(in_Raster, in_Rain, out_GDB, nameTag, cellArea = 1000000, inputT
    - inputType: indicates whether in_Raster is curve numbers (CN) or retention (RET)
    - convFact: conversion factor to convert input rainfall depth units to inches
    - vol: indicates whether a runoff volume raster should (1) or should not (0) be produced.
+   - ret: indicates whether the maximum retention raster calculated from curve numbers should (1) or should not (0) be saved. Ignored if the input is retention.
    '''
    # Set overwrite to be true         
    arcpy.env.overwriteOutput = True
    
-   # Set scratch output location
-   scratchGDB = arcpy.env.scratchGDB
-   
    # Set up some variables
-   in_Raster = Raster(in_Raster)
-   try:
-      in_Rain = Raster(in_Rain)
-   except:
-      pass
    out_Retention = out_GDB + os.sep + "Retention_%s" %nameTag
    out_runoffDepth = out_GDB + os.sep + "runoffDepth_%s" %nameTag
    out_runoffVolume = out_GDB + os.sep + "runoffVol_%s" %nameTag
 
-   # Perform calculations
-   # Result could be raster or a constant depending on input
-   if convFact != 1:
-      rain = convFact*in_Rain 
+   # Rain is either a constant, which stays a Python float and is broadcast in the calculations below, or a raster, which is read block by block along with the input raster.
+   in_Rasters = [in_Raster]
+   if isinstance(in_Rain, (int, float)):
+      rain = float(convFact)*in_Rain
    else:
-      rain = in_Rain
+      in_Rasters.append(in_Rain)
    
-   if inputType == "CN":
-      curvNum = in_Raster
-      print("Calculating maximum retention...")
-      # Have to deal with division by zero here.
-      retention = Con(curvNum == 0, 1000, ((float(1000)/curvNum) - 10))
-      print("Saving...")
-      retention.save(out_Retention)
-   else:
-      retention = in_Raster
+   # Set up the list of outputs, in the order they are returned by the calculations below
+   out_Rasters = [out_runoffDepth]
+   if inputType == "CN" and ret == 1:
+      out_Rasters.insert(0, out_Retention)
+   if vol == 1:
+      out_Rasters.append(out_runoffVolume)
    
-   print("Calculating runoff depth (inches)...")
-   # Set runoff depth to zero if rainfall is less than initial abstraction
-   runoffDepth = Con(curvNum == 0, 0, Con((rain - 0.2*retention) > 0,(rain - 0.2*retention)**2/(rain + 0.8*retention),0))
-   print("Saving...")
-   runoffDepth.save(out_runoffDepth)
+   # Perform calculations for a block of cells. All calculations are done on the arrays.
+   def runoff(inArr, rainArr = None):
+      if rainArr is None:
+         r = rain
+      else:
+         r = rainArr
+         if convFact != 1:
+            r *= convFact
+      outArrs = []
+      
+      if inputType == "CN":
+         # Have to deal with division by zero here. The curve numbers are not needed after this, so retention overwrites them in place.
+         zeroCN = (inArr == 0)
+         inArr[zeroCN] = 1
+         retention = numpy.divide(1000, inArr, out=inArr)
+         retention -= 10
+         retention[zeroCN] = 1000
+         if ret == 1:
+            outArrs.append(retention)
+      else:
+         zeroCN = None
+         retention = inArr
+      
+      # Set runoff depth to zero if rainfall is less than initial abstraction. 
+      # The numerator and denominator are each built in one array and combined in place.
+      runoffDepth = retention*-0.2
+      runoffDepth += r
+      numpy.maximum(runoffDepth, 0, out=runoffDepth)
+      runoffDepth *= runoffDepth
+      denom = retention*0.8
+      denom += r
+      runoffDepth /= denom
+      del denom
+      if zeroCN is not None:
+         runoffDepth[zeroCN] = 0
+      outArrs.append(runoffDepth)
+      
+      if vol == 1:
+         # 2.54 converts inches to cm
+         # 0.001 converts cubic cm to liters
+         volumeConversion = 0.00254*cellArea
+         outArrs.append(volumeConversion*runoffDepth)
+      
+      return outArrs
    
-   if vol == 1:
-      print("Calculating runoff volume (liters)...")
-      # 2.54 converts inches to cm
-      # 0.001 converts cubic cm to liters
-      volumeConversion = 0.00254*cellArea
-      runoffVolume = volumeConversion*runoffDepth
-      print("Saving...")
-      runoffVolume.save(out_runoffVolume)
+   print("Calculating and saving retention, runoff depth (inches), and/or runoff volume (liters)...")
+   BlockApply(in_Rasters, runoff, out_Rasters)
    
    print("Mission accomplished.")
 
@@ -596,11 +656,9 @@ def calcSoilSensScore(in_SoilLoss, in_Runoff, out_GDB, in_Mask = "NONE"):
    - in_Runoff: input raster representing relative potential for runoff under "worst case" land cover conditions (output from eventRunoff function)
    - out_GDB: geodatabase to store outputs
    - in_Mask: Mask raster used to define the processing area
-   '''
    
-   # Set processing environment
-   if in_Mask != "NONE":
-      arcpy.env.mask = in_Mask
+   Note: All input rasters must have the same cell size and alignment. The cutoff values are calculated first; the rescaling and averaging are then done block by block in a single pass, so memory use stays bounded regardless of raster size.
+   '''
    
    # Set up outputs
    soilLossScore = out_GDB + os.sep + "soilLoss_Score"
@@ -611,33 +669,50 @@ def calcSoilSensScore(in_SoilLoss, in_Runoff, out_GDB, in_Mask = "NONE"):
    print("Calculating raster cutoff values...")
    (slTruncMin, slTruncMax) = getTruncVals(in_SoilLoss, in_Mask)
    (roTruncMin, roTruncMax) = getTruncVals(in_Runoff, in_Mask)
-
-   # Rescale the SoilLoss raster
-   print("Rescaling soil loss potential...")
-   Fx = TfLinear ("", "", slTruncMin, 1, slTruncMax, 100) 
-   slScore = RescaleByFunction(in_SoilLoss, Fx, 1, 100)
-   # print("Saving...")
-   slScore.save(soilLossScore)
    
-   # Rescale the Runoff raster
-   print("Rescaling runoff potential...")
-   Fx = TfLinear ("", "", roTruncMin, 1, roTruncMax, 100) 
-   roScore = RescaleByFunction(in_Runoff, Fx, 1, 100)
-   print("Saving...")
-   roScore.save(runoffScore)
-
-   # Take the average of the rescaled values
-   print("Calculating soil sensitivity score...")
-   sens = (slScore + roScore)/2
-   print("Saving...")
-   
-   sens.save(sensScore)
+   # Rescale both inputs and take the average of the rescaled values. Cells outside the mask are set to NoData.
+   in_Rasters = [in_SoilLoss, in_Runoff]
+   if type(in_Mask) != str or in_Mask != "NONE":
+      in_Rasters.append(in_Mask)
+   
+   def sensKernel(sl, ro, m = None):
+      if m is not None:
+         outside = (m == 0) | numpy.isnan(m)
+         sl[outside] = numpy.nan
+         ro[outside] = numpy.nan
+      slScore = rescaleLinear(sl, slTruncMin, slTruncMax, 1, 100)
+      roScore = rescaleLinear(ro, roTruncMin, roTruncMax, 1, 100)
+      sens = slScore + roScore
+      sens *= 0.5
+      return [slScore, roScore, sens]
+   
+   print("Rescaling soil loss and runoff potential, and calculating soil sensitivity score...")
+   BlockApply(in_Rasters, sensKernel, [soilLossScore, runoffScore, sensScore])
+   arcpy.management.CalculateStatistics(sensScore)
    
    print("Mission accomplished.")
 
 
 ### Functions for creating Overland Flow, Karst Prevalence, and Landscape Position Scores
-def calcFlowLength(nhdDir, huList, extent, out_GDB, out_FlowLength):
+def flowLengthHU4(fdrast, out, scratchFolder):
+   '''Calculates downstream flow length from a single HU4 flow direction raster. Used by calcFlowLength, which runs it in a separate process for each HU4. Each call uses its own scratch workspace, to avoid lock contention between processes.
+   
+   Parameters:
+   - fdrast: Flow direction raster
+   - out: Output flow length raster
+   - scratchFolder: Folder in which to create the scratch workspace
+   '''
+   bname = os.path.basename(out)
+   scratchWS = os.path.join(scratchFolder, "flowlen_%s" %bname)
+   os.makedirs(scratchWS, exist_ok = True)
+   arcpy.env.scratchWorkspace = scratchWS
+   print('Calculating flow length for ' + fdrast + '...')
+   with arcpy.EnvManager(outputCoordinateSystem=fdrast, cellSize=fdrast, snapRaster=fdrast):
+      arcpy.sa.FlowLength(fdrast, "DOWNSTREAM").save(out)
+   return out
+
+
+def calcFlowLength(nhdDir, huList, extent, out_GDB, out_FlowLength, numWorkers = None):
    """
    Creates a mosaicked overland flow length raster from a collection of overland flow direction rasters from NHDPlusHR
 
@@ -648,6 +723,7 @@ def calcFlowLength(nhdDir, huList, extent, out_GDB, out_FlowLength):
    - out_GDB: Geodatabase where intermediate outputs are saved (flow length for each HU4). If an intermediate raster
       exists, processing is skipped for that raster.
    - out_FlowLength: Final mosaicked flow length raster
+   - numWorkers: Number of HU4s processed at the same time, in separate processes. Defaults to the number of HU4s or CPUs, whichever is less; reduce this if memory runs short.
    Returns:
       Mosaicked flow length raster.
 
@@ -665,34 +741,42 @@ def calcFlowLength(nhdDir, huList, extent, out_GDB, out_FlowLength):
    base fdroverland.tif raster). It is expected that this bug will be fixed in subsequent NHDPlusHR releases.
    """
    ls = []
+   fdList = []
    for hu in huList:
       fdrast = os.path.join(nhdDir, 'HRNHDPlusRasters' + hu, 'hydrofix.gdb', 'fdroverland_sinkfix')
       if not arcpy.Exists(fdrast):
          fdrast = os.path.join(nhdDir, 'HRNHDPlusRasters' + hu, 'fdroverland.tif')
       if not arcpy.Exists(fdrast):
          raise ValueError("Raster `" + fdrast + "` does not exist.")
-      t1 = time.time()
-      print('Calculating flow length for ' + fdrast + '...')
       out = out_GDB + os.sep + 'flowlengover_' + hu
       ls.append(out)
-      with arcpy.EnvManager(outputCoordinateSystem=fdrast, cellSize=fdrast, snapRaster=fdrast):
-         if not arcpy.Exists(out):
-            arcpy.sa.FlowLength(fdrast, "DOWNSTREAM").save(out)
-         else:
-            print("`" + out + "` already exists, skipping...")
-      t2 = time.time()
-      print('That took ' + str(round((t2 - t1) / 60)) + ' minutes.')
+      if not arcpy.Exists(out):
+         fdList.append((fdrast, out))
+      else:
+         print("`" + out + "` already exists, skipping...")
+
+   # Flow length for each HU4 is independent of the others, so the HU4s are processed in parallel.
+   t1 = time.time()
+   if len(fdList) > 0:
+      if numWorkers is None:
+         numWorkers = min(len(fdList), os.cpu_count())
+      print("Calculating flow length for %s hydrologic units using %s processes..." %(len(fdList), numWorkers))
+      with ProcessPoolExecutor(max_workers = numWorkers) as ex:
+         list(ex.map(flowLengthHU4, [f[0] for f in fdList], [f[1] for f in fdList], repeat(arcpy.env.scratchFolder)))
+   t2 = time.time()
+   print('That took ' + str(round((t2 - t1) / 60)) + ' minutes.')
 
+   # The HU4 rasters only overlap along their edges, so mosaicking streams far less data than stacking them all with CellStatistics. The MAXIMUM method resolves the overlaps the same way CellStatistics did.
    print("Mosaicking flow length rasters, this could take a while...")
+   r = Raster(ls[0])
    with arcpy.EnvManager(outputCoordinateSystem=ls[0], cellSize=ls[0], snapRaster=ls[0], extent=extent):
-      arcpy.sa.CellStatistics(ls, "MAXIMUM", "DATA", "SINGLE_BAND").save(out_FlowLength)
-      arcpy.BuildPyramids_management(out_FlowLength)
+      arcpy.management.MosaicToNewRaster(ls, os.path.dirname(out_FlowLength), os.path.basename(out_FlowLength), r.spatialReference, "32_BIT_FLOAT", r.meanCellWidth, 1, "MAXIMUM")
    t3 = time.time()
    print('That took ' + str(round((t3 - t2) / 60)) + ' minutes.')
    return out_FlowLength
 
 
-def makeHdwtrsIndicator(in_FlowLines, in_Catchments, in_BoundPoly, in_Mask, out_Hdwtrs):
+def makeHdwtrsIndicator(in_FlowLines, in_Catchments, in_BoundPoly, in_Mask, out_Hdwtrs, scratchGDB = "in_memory", in_CatchRaster = "NONE"):
    '''Creates a "Headwaters Indicator" raster, representing presence in a headwater (1) or non-headwater (0) catchment. This is a component of the Landscape Position Score.
    
    NOTE: Flowlines and catchments are assumed to come from NHDPlus-HR, which includes fields to identify headwater streams and link them to their corresponding catchments. It assumes that the field indicating headwater status is already attached to the NHDPlus feature class. If this is not the case this needs to be done first.
@@ -700,50 +784,79 @@ def makeHdwtrsIndicator(in_FlowLines, in_Catchments, in_BoundPoly, in_Mask, out_
    Parameters:
    - in_FlowLines: Input NHDPlus Flowlines (line features)
    - in_Catchments: Input NHDPlus Catchments (polygon features)
-   - in_BoundPoly: Input polygon feature class delimiting the area of interest
+   - in_BoundPoly: Input polygon feature class delimiting the area of interest. Catchments are clipped to this boundary. Ignored if in_CatchRaster is specified.
    - in_Mask: Input raster used to define the processing area, cell size, and alignment
    - out_Hdwtrs: Output raster representing headwater status
+   - scratchGDB: Workspace for the clipped catchments. Defaults to memory; specify a geodatabase on disk if you want to inspect them.
+   - in_CatchRaster: Optional integer raster of the catchments, with cell values equal to the catchments' object IDs, aligned with in_Mask. If specified, the catchments are not clipped or rasterized; instead, each cell's headwaters status is looked up from its object ID, block by block. The raster does not need an attribute table. Rasterize the catchments once (e.g., with PolyToRaster on the object ID field) and reuse the raster for subsequent runs. If the catchments had to be reprojected to rasterize them, pass the reprojected copy as in_Catchments, since reprojection can renumber object IDs.
    
    NOTE: Original version of this function was flawed because some catchments have no flowlines, and thus do not get a headwaters attribute; this left inappropriate holes in the output raster. Updated to replace nulls with zeros.
    '''
    
-   # Set environment variables
-   arcpy.env.snapRaster = in_Mask
-   arcpy.env.cellSize = in_Mask
-   arcpy.env.mask = in_Mask
+   # Set environment variables for the duration of the function
+   with procEnv(in_Mask, extent = None):
    
-   scratchGDB = arcpy.env.scratchGDB
-   print("Scratch products are being written to %s"%scratchGDB)
-
-   # Select the catchments intersecting in_BoundPoly, and save them to a temp feature class
-   tmpCatch = scratchGDB + os.sep + "tmpCatch"
-   print("Selecting catchments within area of interest...")
-   arcpy.MakeFeatureLayer_management(in_Catchments, "catch_lyr")
-   arcpy.SelectLayerByLocation_management("catch_lyr", "intersect", in_BoundPoly)
-   print("Copying subset...")
-   arcpy.management.CopyFeatures("catch_lyr", tmpCatch)
-   
-   # Attach the headwaters indicator field to the catchment subset, then rasterize
-   fldID = "NHDPlusID"
-   fldHead = "StartFlag"
-   print("Joining headwaters indicator field to catchments...")
-   arcpy.JoinField_management(tmpCatch, fldID, in_FlowLines, fldID, fldHead)
-   print("Replacing nulls with zeros...")
-   codeblock = '''def fillNulls(fld):
-      if fld == None:
-         f = 0
+      # Get the headwaters indicator for each flowline.
+      # Flags are looked up from this dictionary in the same cursor pass that writes them, and catchments with no flowline get 0, so no separate join or null replacement pass is needed.
+      fldID = "NHDPlusID"
+      fldHead = "StartFlag"
+      with arcpy.da.SearchCursor(in_FlowLines, [fldID, fldHead]) as curs:
+         headFlags = {row[0]: row[1] for row in curs}
+      
+      if type(in_CatchRaster) == str and in_CatchRaster == "NONE":
+         print(getScratchMsg(scratchGDB))
+
+         # Clip the catchments to in_BoundPoly, and save them to a temp feature class.
+         # PairwiseClip uses a spatial index and runs in parallel, unlike a location selection followed by a copy.
+         tmpCatch = scratchGDB + os.sep + "tmpCatch"
+         print("Clipping catchments to area of interest...")
+         arcpy.analysis.PairwiseClip(in_Catchments, in_BoundPoly, tmpCatch)
+         listFieldNames(tmpCatch, refresh = True)
+      
+         # Attach the headwaters indicator field to the catchment subset, then rasterize.
+         print("Attaching headwaters indicator field to catchments...")
+         catchFlds = listFieldNames(tmpCatch)
+         if fldHead in catchFlds:
+            arcpy.management.DeleteField(tmpCatch, fldHead)
+         arcpy.management.AddField(tmpCatch, fldHead, "SHORT")
+         catchFlds.add(fldHead)
+         with arcpy.da.UpdateCursor(tmpCatch, [fldID, fldHead]) as curs:
+            for row in curs:
+               row[1] = headFlags.get(row[0]) or 0
+               curs.updateRow(row)
+         del headFlags
+         print("Rasterizing...")
+         PolyToRaster(tmpCatch, fldHead, in_Mask, out_Hdwtrs)   
+         
+         # Cleanup
+         if scratchGDB == "in_memory":
+            garbagePickup([tmpCatch])
+      
       else:
-         f = fld
-      return f
-   '''
-   expression = "fillNulls(!%s!)"%fldHead
-   arcpy.management.CalculateField(tmpCatch, fldHead, expression, "PYTHON3", codeblock)
-   print("Rasterizing...")
-   PolyToRaster(tmpCatch, fldHead, in_Mask, out_Hdwtrs)   
+         # Build a lookup array of headwaters flags indexed by catchment object ID. A raster with this many unique values may have no attribute table, so the flags are not attached to one.
+         # The array has one extra zero at the end; cell values with no matching catchment are clipped to it, and get 0.
+         print("Building headwaters lookup for catchment raster...")
+         with arcpy.da.SearchCursor(in_Catchments, ["OID@", fldID]) as curs:
+            catchFlags = {row[0]: headFlags.get(row[1]) or 0 for row in curs}
+         del headFlags
+         headLUT = numpy.zeros(max(catchFlags, default = 0) + 2, dtype = numpy.uint8)
+         for (oid, flag) in catchFlags.items():
+            headLUT[oid] = flag
+         del catchFlags
+         
+         def hdwKernel(zone, m):
+            out = numpy.full(zone.shape, 255, dtype = numpy.uint8)
+            valid = ~numpy.isnan(zone) & ~numpy.isnan(m)
+            out[valid] = numpy.take(headLUT, zone[valid].astype(numpy.int64), mode = "clip")
+            return out
+         
+         # Object IDs are read as 64-bit floats, which hold them exactly
+         print("Looking up headwaters status...")
+         BlockApply([in_CatchRaster, in_Mask], hdwKernel, out_Hdwtrs, 255, dtype = numpy.float64)
    
-   print("Mission complete.")
+      print("Mission complete.")
    
-   return out_Hdwtrs
+      return out_Hdwtrs
 
 def calcFlowScore(in_FlowLength, out_FlowScore, in_Hdwtrs = "NONE", minDist = 50, maxDist = 500, discount = 0.9):
    '''Creates a "Flow Distance Score" raster, in which cells within a specified flow distance to water are scored 100, and cells farther than a specified flow distance are scored 1. A headwaters indicator raster may optionally be used to "discount" cells not within headwater catchments. This is a component of the Landscape Position Score.
@@ -757,29 +870,38 @@ def calcFlowScore(in_FlowLength, out_FlowScore, in_Hdwtrs = "NONE", minDist = 50
    - minDist: The flow distance threshold below which the (non-discounted) score is set to 100.
    - maxDist: The flow distance threshold above which the (non-discounted) score is set to 1.
    - discount: A value multiplied by the initial score to get the final score (ignored if no headwaters raster is specified). If the initial score is 100, but the cell is not in a headwater catchment and the discount value is 0.9, the final score will be 90.
-   '''
-   
-   # Set environment variables
-   if in_Hdwtrs != "NONE":
-      arcpy.env.mask = in_Hdwtrs
    
-   # Rescale the flow length raster to scores 
-   print("Rescaling flow lengths to scores...")
-   Fx = TfLinear ("", "", minDist, 100, maxDist, 1) 
-   flowScore = RescaleByFunction(in_FlowLength, Fx, 100, 1)
+   Note: If a headwaters raster is specified, it determines the output extent, cell size, and alignment, and cells where it is NoData are NoData in the output. If the flow length raster is on a different grid, it is first resampled (nearest neighbor) to match. The rescaling and discount are applied in a single pass over the inputs.
+   '''
    
-   # Discount scores
    if in_Hdwtrs == "NONE":
-      finScore = flowScore
+      print("Rescaling flow lengths to scores...")
+      BlockApply(in_FlowLength, lambda fl: flowScoreArr(fl, None, minDist, maxDist, discount), out_FlowScore)
    else:
-      print("Discounting non-headwater scores...")
-      finScore = Con(Raster(in_Hdwtrs)==0, discount*flowScore, flowScore)
-   print("Saving...")
-   finScore.save(out_FlowScore)
+      # Put the flow lengths on the headwaters grid, if they are not already
+      flowLength = AlignToMatch_ras(in_FlowLength, in_Hdwtrs, arcpy.env.scratchGDB + os.sep + "flowLength_aln")
+      print("Rescaling flow lengths to scores and discounting non-headwater scores...")
+      BlockApply([in_Hdwtrs, flowLength], lambda hdw, fl: flowScoreArr(fl, hdw, minDist, maxDist, discount), out_FlowScore)
+      if flowLength != in_FlowLength:
+         garbagePickup([flowLength])
+   
+   return Raster(out_FlowScore)
+
+def flowScoreArr(in_FlowLength, in_Hdwtrs, minDist, maxDist, discount):
+   '''Converts an array of flow lengths to Flow Distance Scores, as in calcFlowScore. The rescaling and headwaters discount are applied in place in the same array.
    
-   return finScore
+   Parameters:
+   - in_FlowLength: Array of overland flow distances to water
+   - in_Hdwtrs: Array indicating whether cells are within a headwater catchment (1) or not (0), with NaN for NoData; or None if no discount is desired
+   - minDist, maxDist, discount: as in calcFlowScore
+   '''
+   score = rescaleLinear(in_FlowLength, minDist, maxDist, 100, 1)
+   if in_Hdwtrs is not None:
+      score[in_Hdwtrs == 0] *= discount
+      score[numpy.isnan(in_Hdwtrs)] = numpy.nan
+   return score
 
-def calcSinkDensity(in_SinkPolys, fld_Area, procMask, out_GDB, searchRadius = 5000):
+def calcSinkDensity(in_SinkPolys, fld_Area, procMask, out_GDB, searchRadius = 5000, keepIntermediates = False):
    '''From input sinkhole polygons, generates sinkhole centroids and a raster representing sinkhole density
    
      Parameters:
@@ -788,40 +910,53 @@ def calcSinkDensity(in_SinkPolys, fld_Area, procMask, out_GDB, searchRadius = 50
    - procMask: Mask raster used to define the processing area, cell size, and alignment
    - out_GDB: Geodatabase to store output products
    - searchRadius: Search radius used to calculate kernel density
+   - keepIntermediates: If True, the sinkhole centroids (sinkPoints, in the coordinate system of procMask) are saved in out_GDB. Otherwise they are written to the scratch geodatabase and deleted when done, and only the density raster is saved.
    
    Note: Prior to running this function, make sure the sinkhole data are "clean", i.e., no overlaps/duplicates. There must also be a field representing the sinkhole area in desired units.
    '''
    
-   # Set environment variables
-   arcpy.env.mask = procMask
-   arcpy.env.extent = procMask
-   arcpy.env.snapRaster = procMask
-   arcpy.env.cellSize = procMask
-   
-   # Set up outputs
-   sinkPoints = out_GDB + os.sep + "sinkPoints"
-   sinkPoints_prj = out_GDB + os.sep + "sinkPoints_prj"
-   sinkDens = out_GDB + os.sep + "sinkDens"
+   # Set environment variables for the duration of the function
+   with procEnv(procMask):
    
-   # Generate sinkhole centroids
-   print("Generating sinkhole centroids...")
-   arcpy.FeatureToPoint_management(in_SinkPolys, sinkPoints)
-   
-   # Run kernel density
-   print("Calculating kernel density...")
-   pts = ProjectToMatch_vec(sinkPoints, procMask, sinkPoints_prj, copy = 0)
-   kdens = KernelDensity(pts, fld_Area, procMask, searchRadius, "HECTARES", "DENSITIES", "PLANAR")
-   print("Saving...")
-   kdens.save(sinkDens)
+      # Set up outputs
+      if keepIntermediates:
+         intGDB = out_GDB
+      else:
+         intGDB = arcpy.env.scratchGDB
+      sinkPoints = intGDB + os.sep + "sinkPoints"
+      sinkDens = out_GDB + os.sep + "sinkDens"
+   
+      # Generate sinkhole centroids, in the coordinate system of procMask
+      # Only the centroid coordinates and the area field are read, rather than copying each polygon's full geometry and attributes as FeatureToPoint does. The coordinates are projected as they are read, so there is no separate reprojected copy of the points.
+      print("Generating sinkhole centroids...")
+      (sr_In, sr_Out, reproject, transform, geoTrans) = CompareSpatialRef(in_SinkPolys, procMask)
+      with arcpy.EnvManager(geographicTransformations = geoTrans):
+         sinks = arcpy.da.FeatureClassToNumPyArray(in_SinkPolys, ["SHAPE@XY", fld_Area], spatial_reference = sr_Out, null_value = 0)
+      arcpy.da.NumPyArrayToFeatureClass(sinks, sinkPoints, ["SHAPE@XY"], sr_Out)
+      del sinks
+   
+      # Run kernel density
+      # Density is zero beyond the search radius of every point, so the kernel density is only calculated within the point extent expanded by the search radius. The rest of the processing area is filled with zeros.
+      print("Calculating kernel density...")
+      ext = arcpy.Describe(sinkPoints).extent
+      kdExtent = arcpy.Extent(ext.XMin - searchRadius, ext.YMin - searchRadius, ext.XMax + searchRadius, ext.YMax + searchRadius)
+      # The kernel density is spread across all available cores.
+      with arcpy.EnvManager(extent = kdExtent, parallelProcessingFactor = "100%"):
+         kd = KernelDensity(sinkPoints, fld_Area, procMask, searchRadius, "HECTARES", "DENSITIES", "PLANAR")
+      kdens = Con(IsNull(kd), 0, kd)
+      print("Saving...")
+      kdens.save(sinkDens)
+      if not keepIntermediates:
+         garbagePickup([sinkPoints])
    
-   return kdens
+      return kdens
    
-   print("Mission accomplished.")
+      print("Mission accomplished.")
 
-def calcKarstScore(in_KarstPolys, procMask, clipMask, out_GDB, in_SinkDens = "NONE", minDist = 100, maxDist = 5000):
-   '''From karst polygons and an optional sinkhole density raster, generates three or four outputs:
+def calcKarstScore(in_KarstPolys, procMask, clipMask, out_GDB, in_SinkDens = "NONE", minDist = 100, maxDist = 5000, keepIntermediates = False):
+   '''From karst polygons and an optional sinkhole density raster, generates a final karst score raster, and optionally (if keepIntermediates is True) the intermediate rasters from which it is derived:
    - A raster representing karst polygons
-   - A raster representing distance to karst
+   - A raster representing distance to karst (up to maxDist)
    - A raster representing distance scores from 1 to 100 
    - A raster representing density scores from 1 to 100 (only if density raster is provided)
    - A raster representing the final karst score from 1 to 100 (same as distance score if no density raster provided)
@@ -834,69 +969,91 @@ def calcKarstScore(in_KarstPolys, procMask, clipMask, out_GDB, in_SinkDens = "NO
    - in_SinkDens: Raster representing sinkhole density (generated by calcSinkDensity function). May be omitted (set to "NONE") for a simpler karst score based only on distance to karst geology.
    - minDist: Minimum distance to karst, below which the score is 100
    - maxDist: Maximum distance to karst, above which the score is 1
+   - keepIntermediates: If True, the karst polygon, distance, distance score, and density score rasters are saved in out_GDB. Otherwise, the karst polygon and distance rasters are written to the scratch geodatabase and deleted when done, the score rasters are not written at all, and only the final karst score is saved.
    
    Justification for default minDist and maxDist default values:
    I calculated distance between sinkhole centroids and karst polygons. 97.3% of points were within 100 m of polygons. Only one point was greater than 5000 m from a polygon; the distance for that point was ~5200 m.
+   
+   Note: The sinkhole density raster must have the same cell size and alignment as the processing mask. Distances are calculated only as far out from the clip mask as they can affect it. The distance, density, and final scores are all calculated in a single block-by-block pass on the processing mask grid, and are then limited to the clip mask (which may have a different cell size or alignment), within the clip mask extent.
    '''
 
-   # Set environment variables
-   arcpy.env.mask = procMask
-   arcpy.env.snapRaster = procMask
-   arcpy.env.cellSize = procMask
+   # Set environment variables for the duration of the function
+   with procEnv(procMask):
    
-   # Set up outputs
-   karst_Raster = out_GDB + os.sep + "karst_Raster"
-   karst_eDist = out_GDB + os.sep + "karst_eDist" 
-   karst_distScore = out_GDB + os.sep + "karst_distScore" 
-   karst_densScore = out_GDB + os.sep + "karst_densScore"
-   KarstScore = out_GDB + os.sep + "KarstScore" 
-
-   # Convert karst polygons to raster
-   print("Converting karst polygons to raster...")
-   PolyToRaster(in_KarstPolys, "OBJECTID", procMask, karst_Raster)
-
-   # Get Euclidean Distance and Distance Score
-   print("Getting Euclidean distance to karst...")
-   edist = EucDistance(karst_Raster, "", arcpy.env.cellSize)
-   print("Saving...")
-   edist.save(karst_eDist)
-   print("Converting distances to scores...")
-   arcpy.env.mask = clipMask
-   Fx = TfLinear ("", "", minDist, 100, maxDist, 1) 
-   distScore = RescaleByFunction(karst_eDist, Fx, 100, 1)
- 
-   # Get Density Score (if sinkhole density is supplied)
-   if in_SinkDens != "NONE":
-      print("Saving...")
-      distScore.save(karst_distScore)
-      distScore = Raster(karst_distScore)
-      sinkDens = Raster(in_SinkDens)
-      
-      print("Working on sinkhole density...")
-      print("Calculating truncation values...")
-      msk = Con(sinkDens > 0, 1)
-      (TruncMin, TruncMax) = getTruncVals(sinkDens, msk)
-      TruncMax = int(TruncMax)
-      Fx = TfLinear ("", "", 0, 1, TruncMax, 100)
-      print("Truncation values set to 0, %s." %TruncMax)
-      print("Converting densities to scores...")
-      arcpy.env.mask = clipMask
-      densScore = RescaleByFunction(sinkDens, Fx, 1, 100)
-      print("Saving...")
-      densScore.save(karst_densScore)
+      # Set up outputs
+      if keepIntermediates:
+         intGDB = out_GDB
+      else:
+         intGDB = arcpy.env.scratchGDB
+      karst_Raster = intGDB + os.sep + "karst_Raster"
+      karst_eDist = intGDB + os.sep + "karst_eDist" 
+      karst_distScore = out_GDB + os.sep + "karst_distScore" 
+      karst_densScore = out_GDB + os.sep + "karst_densScore"
+      KarstScore = out_GDB + os.sep + "KarstScore" 
 
-      # Get final Karst Score
-      print("Calculating final Karst Score from distance and density scores...")
-      comboScore = CellStatistics([densScore, distScore], "MEAN", "DATA")
+      # Convert karst polygons to raster
+      print("Converting karst polygons to raster...")
+      PolyToRaster(in_KarstPolys, "OBJECTID", procMask, karst_Raster)
+
+      # Get Euclidean Distance and Distance Score
+      # Distances beyond maxDist all get the minimum score, so the distance calculation stops there. Cells beyond maxDist are NoData in the distance raster, and are scored 1.
+      print("Getting Euclidean distance to karst, up to %s..." %maxDist)
+      # Distances are only scored within clipMask, but karst up to maxDist outside it still determines those distances, so the distance calculation covers the clipMask extent expanded by maxDist. The calculation is spread across all available cores.
+      ce = arcpy.Describe(clipMask).extent
+      distExtent = arcpy.Extent(ce.XMin - maxDist, ce.YMin - maxDist, ce.XMax + maxDist, ce.YMax + maxDist)
+      with arcpy.EnvManager(extent = distExtent, parallelProcessingFactor = "100%"):
+         edist = EucDistance(karst_Raster, maxDist, arcpy.env.cellSize)
       print("Saving...")
-      comboScore.save(KarstScore)
-      return comboScore
+      edist.save(karst_eDist)
+
+      # Distance score: rescale distances, and set cells beyond maxDist (NoData in the capped distance raster) to 1
+      def distKernel(d):
+         score = rescaleLinear(d, minDist, maxDist, 100, 1)
+         score[numpy.isnan(d)] = 1
+         return score
+ 
+      # Get Density Score (if sinkhole density is supplied)
+      if in_SinkDens != "NONE":
+         print("Working on sinkhole density...")
+         print("Calculating truncation values...")
+         # Densities are never negative, so the nonzero cells are the cells with density greater than 0
+         (TruncMin, TruncMax) = getTruncVals(in_SinkDens, "NONZERO")
+         TruncMax = int(TruncMax)
+         print("Truncation values set to 0, %s." %TruncMax)
+      
+         # Density score: rescale densities. Final score is the mean of the distance and density scores.
+         def karstKernel(d, dens):
+            distScore = distKernel(d)
+            densScore = rescaleLinear(dens, 0, TruncMax, 1, 100)
+            if keepIntermediates:
+               return [distScore, densScore, meanScore(distScore, densScore)]
+            return meanScore(distScore, densScore)
+      
+         print("Converting distances and densities to scores, and calculating final Karst Score...")
+         if keepIntermediates:
+            outRasters = [karst_distScore, karst_densScore, KarstScore]
+         else:
+            outRasters = [KarstScore]
+         tmpRasters = [arcpy.env.scratchGDB + os.sep + os.path.basename(r) + "_full" for r in outRasters]
+         BlockApply([karst_eDist, in_SinkDens], karstKernel, tmpRasters if keepIntermediates else tmpRasters[0])
    
-   else:
-      print("Karst score is based only on Euclidean distance. Saving...")
-      distScore.save(KarstScore)
-      return distScore
-   print("Mission accomplished.")
+      else:
+         print("Karst score is based only on Euclidean distance. Converting distances to scores...")
+         outRasters = [KarstScore]
+         tmpRasters = [arcpy.env.scratchGDB + os.sep + "KarstScore_full"]
+         BlockApply(karst_eDist, distKernel, tmpRasters[0])
+      
+      # Limit the scores to clipMask. The scores stay on the procMask grid; only the extent and mask come from clipMask.
+      print("Limiting scores to clip mask...")
+      with arcpy.EnvManager(extent = ce):
+         for (tmp, out) in zip(tmpRasters, outRasters):
+            ExtractByMask(tmp, clipMask).save(out)
+      garbagePickup(tmpRasters)
+      if not keepIntermediates:
+         garbagePickup([karst_Raster, karst_eDist])
+   
+      print("Mission accomplished.")
+      return Raster(KarstScore)
 
 def calcPositionScore(in_FlowScore, in_KarstScore, out_PositionScore):
    '''Creates a "Landscape Position Score" raster, representing relative importance to stream health based on position in the landscape. It is the maximum of the Karst Score and the Flow Distance Score.
@@ -905,16 +1062,21 @@ def calcPositionScore(in_FlowScore, in_KarstScore, out_PositionScore):
    - in_FlowScore: Input raster representing the Flow Distance Score
    - in_KarstScore: Input raster representing the Karst Score
    - out_PositionScore: Output raster representing the Landscape Position Score
+   
+   Note: The output has the extent, cell size, and alignment of the Flow Distance Score raster, and is processed block by block. If the Karst Score raster is on a different grid, it is first resampled (nearest neighbor) to match.
    '''
    
-   # Calculate score
+   # Put the Karst Score on the Flow Distance Score grid, if it is not already
+   karstScore = AlignToMatch_ras(in_KarstScore, in_FlowScore, arcpy.env.scratchGDB + os.sep + "karstScore_aln")
+   
+   # Calculate score, ignoring NoData in either input (same as CellStatistics MAXIMUM with DATA)
    print("Calculating Landscape Position Score...")
-   score = CellStatistics([in_FlowScore, in_KarstScore], "MAXIMUM", "DATA")
-   print("Saving...")
-   score.save(out_PositionScore)
+   BlockApply([in_FlowScore, karstScore], numpy.fmax, out_PositionScore)
+   if karstScore != in_KarstScore:
+      garbagePickup([karstScore])
    
    print("Mission accomplished.")
-   return score
+   return Raster(out_PositionScore)
 
 def calcImpactScore(in_PositionScore, in_SoilSensScore, out_ImpactScore):
    '''Creates a raster representing the potential impact, based on landscape position and soil sensitivity. 
@@ -923,35 +1085,82 @@ def calcImpactScore(in_PositionScore, in_SoilSensScore, out_ImpactScore):
    - in_PositionScore: Input raster representing relative importance based on landscape position
    - in_SoilSensScore: Input raster representing relative importance based on soil sensitivity
    - out_ImpactScore: The output raster representing either the Impact Score (if there is no input Importance Score) or the General Priority Score (if there is an input Importance Score used to adjust the Impact Score).
+   
+   Note: The output has the extent, cell size, and alignment of the Landscape Position Score raster, and is processed block by block. If the Soil Sensitivity Score raster is on a different grid, it is first resampled (nearest neighbor) to match.
    '''
 
+   # Put the Soil Sensitivity Score on the Landscape Position Score grid, if it is not already
+   soilScore = AlignToMatch_ras(in_SoilSensScore, in_PositionScore, arcpy.env.scratchGDB + os.sep + "soilSensScore_aln")
+
    print("Calculating Impact Score...")
-   score = CellStatistics([in_PositionScore, in_SoilSensScore], "MEAN", "DATA")
-      
-   print("Saving...")
-   score.save(out_ImpactScore)
+   BlockApply([in_PositionScore, soilScore], meanScore, out_ImpactScore)
+   if soilScore != in_SoilSensScore:
+      garbagePickup([soilScore])
+   
+   print("Mission accomplished.")
+   return Raster(out_ImpactScore)
+   
+def calcFlowPositionImpact(in_FlowLength, in_Hdwtrs, in_KarstScore, in_SoilSensScore, out_FlowScore, out_PositionScore, out_ImpactScore, minDist = 50, maxDist = 500, discount = 0.9):
+   '''Creates the Flow Distance Score, Landscape Position Score, and Impact Score rasters in a single pass. The results are the same as running calcFlowScore, calcPositionScore, and calcImpactScore in sequence, but each input is read once, and the flow and position scores are not read back from disk to calculate the next score.
+   
+   Parameters:
+   - in_FlowLength: Input raster representing the overland flow distance to water
+   - in_Hdwtrs: Input raster indicating whether cells are within a headwater catchment (1) or not (0), used to "discount" non-headwater values. Determines the output extent.
+   - in_KarstScore: Input raster representing the Karst Score
+   - in_SoilSensScore: Input raster representing the Soil Sensitivity Score
+   - out_FlowScore: Output raster representing the Flow Distance Score
+   - out_PositionScore: Output raster representing the Landscape Position Score
+   - out_ImpactScore: Output raster representing the Impact Score
+   - minDist, maxDist, discount: as in calcFlowScore
+   
+   Note: The outputs have the extent, cell size, and alignment of the headwaters raster. Any other input on a different grid (e.g., the flow length raster in the NHDPlus coordinate system, or the Karst Score on the coarser processing mask grid) is first resampled (nearest neighbor) to match.
+   '''
+   
+   # Put the other inputs on the headwaters grid, if they are not already
+   scratchGDB = arcpy.env.scratchGDB
+   in_Rasters = [in_Hdwtrs]
+   alnList = []
+   for (ras, name) in ((in_FlowLength, "flowLength_aln"), (in_KarstScore, "karstScore_aln"), (in_SoilSensScore, "soilSensScore_aln")):
+      aln = AlignToMatch_ras(ras, in_Hdwtrs, scratchGDB + os.sep + name)
+      in_Rasters.append(aln)
+      if aln != ras:
+         alnList.append(aln)
+   
+   def impactKernel(hdw, fl, karst, soil):
+      flowScore = flowScoreArr(fl, hdw, minDist, maxDist, discount)
+      posScore = numpy.fmax(flowScore, karst)
+      return [flowScore, posScore, meanScore(posScore, soil)]
+   
+   print("Calculating Flow Distance, Landscape Position, and Impact Scores...")
+   BlockApply(in_Rasters, impactKernel, [out_FlowScore, out_PositionScore, out_ImpactScore])
+   garbagePickup(alnList)
    
    print("Mission accomplished.")
-   return out_ImpactScore
+   return Raster(out_ImpactScore)
    
 def finalize_gdbRas2Tif(gdbRaster, mask, outPath):
-   '''Converts gdb raster to integerized tif format, limited to mask area, and builds pyramids
+   '''Converts gdb raster to integerized (8-bit unsigned) tif format, limited to mask area, and builds pyramids
    
    Parameters:
    - gdbRaster - input raster in GDB format
-   - mask - mask raster determining footprint of output
+   - mask - mask raster (or polygons) determining footprint of output
    - outPath - the path to the folder where TIF raster should be saved
+   
+   The processing extent is set to the mask's extent, aligned with the input raster, so cells outside the mask's bounding box are never read or written.
    '''
-   arcpy.env.mask = mask
    name = os.path.basename(gdbRaster)
    print("Working on %s..."%name)
    arcpy.CreateFolder_management(outPath, name)
    outTif = outPath + os.sep + name + os.sep + "%s.tif"%name
    r = Raster(gdbRaster)
-   print("Integerizing...")
-   intRas = Int(0.5+r)
-   print("Saving...")
-   intRas.save(outTif)
-   print("Building pyramids...")
-   arcpy.management.BuildPyramids(outTif)
+   
+   # Set environment variables for the duration of the conversion only
+   with arcpy.EnvManager(mask = mask, extent = arcpy.Describe(mask).extent, snapRaster = gdbRaster):
+      print("Integerizing...")
+      intRas = Int(0.5+r)
+      # Scores range from 1 to 100, so they fit in 8-bit unsigned integers, with 0 free for NoData; Int produces 32-bit integers, which would make the tif four times larger.
+      # Statistics and pyramids are built as part of the copy, rather than in a separate pass over the tif afterward. Scores are smooth and bounded, so they compress well losslessly.
+      print("Saving as compressed 8-bit unsigned integer, with pyramids...")
+      with arcpy.EnvManager(rasterStatistics = finalStats, pyramid = "PYRAMIDS -1 NEAREST", compression = "LZW"):
+         arcpy.management.CopyRaster(intRas, outTif, nodata_value = "0", pixel_type = "8_BIT_UNSIGNED")
    print("Done.")
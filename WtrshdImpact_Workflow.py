@@ -23,9 +23,25 @@ from HelperPro import *
 
 import WtrshdImpact_Functions
 from WtrshdImpact_Functions import *
+from concurrent.futures import ProcessPoolExecutor
+
+def isDone(out, rerun = 0):
+   '''Checks whether a workflow stage can be skipped because its output already exists, so that an interrupted or partial run can be resumed without repeating finished stages. Existence is all that is checked: if an input to a stage changes, delete that stage's output and everything downstream of it, or set rerun to 1.
+   
+   Parameters:
+   - out: output (or last output) of the stage
+   - rerun: if 1, the stage is never skipped
+   '''
+   if rerun == 0 and arcpy.Exists(out):
+      print("`" + out + "` already exists, skipping...")
+      return True
+   return False
 
 def main():
    
+   # Let Spatial Analyst tools that support it use all cores. This is set here rather than in the functions module so that it does not apply inside the worker processes, which already divide the cores among themselves.
+   arcpy.env.parallelProcessingFactor = "100%"
+   
    ### Input Data ###
    
    # Processing geodatabase and masks
@@ -72,8 +88,17 @@ def main():
    KarstPolys = r"Y:\SpatialData\USGS\USKarstMap\USKarstMap.gdb\Contiguous48\Carbonates48" # downloaded from https://pubs.usgs.gov/of/2014/1156/
    # fixme: object name in calcSinkDensity call is 'in_SinkPolys'. Also missing `fld_Area` definition.
    SinkPolys = r"Y:\SpatialData\DMME\Sinkholes_VaDMME_2020SeptCurrent\Sinkholes_VaDMME.shp" # obtained by request from DMME
+   
+   # Pyramids are only needed to view rasters, not to process them. Set to 1 to build pyramids for the processed rasters in procGDB at the end of the run. (The finalized TIFs always get pyramids.)
+   buildPyramids = 0
+   
+   # Stages whose outputs already exist in procGDB are skipped (see isDone). Set to 1 to run every stage regardless.
+   rerun = 0
 
    ### End Input Data ###
+   
+   # Processed rasters to build pyramids for, at the end of the run
+   pyrList = []
 
 
    ### Soil Loss Potential procedures ###
@@ -81,34 +106,36 @@ def main():
    
    ## Prepare the R-factor raster
    # Requires coarse-scale R-factor raster (in_Rfactor) from NOAA
-   print("Downscaling R-factor raster...")
    Rfactor = procGDB + os.sep + "rusleR" # downscaled raster
-   Downscale_ras(in_Rfactor, in_Elev, Rfactor, "BILINEAR", clpShp)
-   print("Building pyramids...")
-   arcpy.management.BuildPyramids(Rfactor)
+   if not isDone(Rfactor, rerun):
+      print("Downscaling R-factor raster...")
+      Downscale_ras(in_Rfactor, in_Elev, Rfactor, "BILINEAR", clpShp)
+   pyrList.append(Rfactor)
    print("Downscaled R-factor raster complete.")
    
    ## Prepare the K-factor raster
    # Requires pre-processed SSURGO geodatabase(s) listed in gdbList
-   for gdb in gdbList:
-      print("Processing K-factor for %s..."%gdb)
-      Kfactor_vec(gdb)
-   print("K-factors complete.")
    Kfactor = procGDB + os.sep + "rusleK"
-   print("Rasterizing K-factors...")
-   SSURGOtoRaster(gdbList, "kFactor", in_Elev, Kfactor)
-   print("Building pyramids...")
-   arcpy.management.BuildPyramids(Kfactor)
+   if not isDone(Kfactor, rerun):
+      # The geodatabases are independent of each other, so they are processed in parallel, one process per geodatabase (up to the number of CPUs).
+      print("Processing K-factors for %s geodatabases..."%len(gdbList))
+      with ProcessPoolExecutor(max_workers = min(len(gdbList), os.cpu_count())) as ex:
+         list(ex.map(Kfactor_vec, gdbList))
+      print("K-factors complete.")
+      print("Rasterizing K-factors...")
+      SSURGOtoRaster(gdbList, "kFactor", in_Elev, Kfactor)
+   pyrList.append(Kfactor)
    print("K-factor raster complete.")
    
    ## Prepare the S-factor raster
    # Requires an elevation raster (in_Elev). In this case we used a DEM with elevation in cm, hence the zfactor below.
    Sfactor = procGDB + os.sep + "rusleS"
    slope_perc = procGDB + os.sep + "slope_perc"
-   print("Transforming slope to S-factor...")
-   SlopeTrans(in_Elev, "ELEV", "RUSLE", Sfactor, slope_perc, zfactor = 0.01)
-   print("Building pyramids...")
-   arcpy.management.BuildPyramids(Sfactor)
+   if not isDone(Sfactor, rerun):
+      print("Transforming slope to S-factor...")
+      SlopeTrans(in_Elev, "ELEV", "RUSLE", Sfactor, slope_perc, zfactor = 0.01)
+   # --> If other slope transformations are needed (e.g., TRUNCLIN), use slope_perc as the input with inputType "PERCENT" rather than deriving slope again
+   pyrList.append(Sfactor)
    print("S-factor raster complete.")
    
    ## No need for C-factor raster; we are assuming worst-case scenario, bare soil, so use a constant value (from OpenNSPECT)
@@ -116,10 +143,10 @@ def main():
    
    ## Prepare the soil loss raster based on RUSLE factors created above, assuming bare soil
    soilLoss_bare = procGDB + os.sep + "rusleRKSC_bare"
-   print("Generating barren land soil loss raster...")
-   soilLoss_RKSC(Rfactor, Kfactor, Sfactor, Cfactor, soilLoss_bare)
-   print("Building pyramids...")
-   arcpy.management.BuildPyramids(soilLoss_bare)
+   if not isDone(soilLoss_bare, rerun):
+      print("Generating barren land soil loss raster...")
+      soilLoss_RKSC(Rfactor, Kfactor, Sfactor, Cfactor, soilLoss_bare)
+   pyrList.append(soilLoss_bare)
    print("Barren land soil loss raster complete.")
    
    
@@ -129,59 +156,61 @@ def main():
    ## Prepare the rainfall raster: Probable Maximum Precipitation (PMP)
    # Requires rainfall points generated from Dam Safety's PMP tool (pmpPts, with attributes in pmpFld)
    # Note: Interpolated to coarse scale first b/c memory was failing otherwise.
-   maxPrecip250 = procGDB + os.sep + "maxPrecip_gen24_topo250"
+   # The coarse raster is small and only feeds the downscaling, so it is kept in memory rather than written to procGDB.
+   maxPrecip250 = "in_memory" + os.sep + "maxPrecip_gen24_topo250"
    maxPrecip10 = procGDB + os.sep + "maxPrecip_gen24_topo10"
-   print("Interpolating rainfall points...")
-   interpPoints(pmpPts, pmpFld, in_Elev, maxPrecip250, clpShp, "TOPO", "", "", 250) # interpolate 
-   print("Downscaling interpolated rainfall raster...")
-   Downscale_ras(maxPrecip250, in_Elev, maxPrecip10, "BILINEAR", clpShp) # downscale
-   print("Building pyramids...")
-   arcpy.management.BuildPyramids(maxPrecip10)
+   if not isDone(maxPrecip10, rerun):
+      print("Interpolating rainfall points...")
+      interpPoints(pmpPts, pmpFld, in_Elev, maxPrecip250, clpShp, "TOPO", "", "", 250) # interpolate 
+      print("Downscaling interpolated rainfall raster...")
+      Downscale_ras(maxPrecip250, in_Elev, maxPrecip10, "BILINEAR", clpShp) # downscale
+      garbagePickup([maxPrecip250])
+   pyrList.append(maxPrecip10)
    print("Rainfall raster complete.")
    
    
    ## Prepare the hydro group raster
    # Requires pre-processed SSURGO geodatabase(s) listed in gdbList
-   for gdb in gdbList:
-      print("Processing hydro group for %s..."%gdb)
-      HydroGrp_vec(gdb)
-   print("Hydro groups complete.")
    hydroGrp = procGDB + os.sep + "HydroGroup"
-   print("Rasterizing hydro groups...")
-   SSURGOtoRaster(gdbList, "HydroGrpNum", in_Elev, hydroGrp)
-   print("Building pyramids...")
-   arcpy.management.BuildPyramids(hydroGrp)
+   if not isDone(hydroGrp, rerun):
+      # As for K-factors, the geodatabases are processed in parallel.
+      print("Processing hydro groups for %s geodatabases..."%len(gdbList))
+      with ProcessPoolExecutor(max_workers = min(len(gdbList), os.cpu_count())) as ex:
+         list(ex.map(HydroGrp_vec, gdbList))
+      print("Hydro groups complete.")
+      print("Rasterizing hydro groups...")
+      SSURGOtoRaster(gdbList, "HydroGrpNum", in_Elev, hydroGrp)
+   pyrList.append(hydroGrp)
    print("Hydro group raster complete.")
    
    ## Prepare the curve number raster
    # Curve number based on soil hydro group only, assuming bare soil (NLCD code 31)
    curvNum_bare = procGDB + os.sep + "curvNum_bare"
-   print("Creating barren land curve number raster...")
-   curvNum(31, hydroGrp, curvNum_bare) 
-   print("Building pyramids...")
-   arcpy.management.BuildPyramids(curvNum_bare)
+   if not isDone(curvNum_bare, rerun):
+      print("Creating barren land curve number raster...")
+      curvNum(31, hydroGrp, curvNum_bare) 
+   pyrList.append(curvNum_bare)
    print("Barren land curve number raster complete.")
    
    ## Prepare the runoff raster based on SCS curve-number method, assuming bare soil
-   print("Creating barren land runoff raster...")
-   eventRunoff(curvNum_bare, maxPrecip10, procGDB, "bare")
-   # --> Relevant output is runoffDepth_bare
+   # --> Relevant output is runoffDepth_bare (retention is not saved unless ret = 1)
    runoffDepth_bare = procGDB + os.sep + "runoffDepth_bare"
-   print("Building pyramids...")
-   arcpy.management.BuildPyramids(runoffDepth_bare)
+   if not isDone(runoffDepth_bare, rerun):
+      print("Creating barren land runoff raster...")
+      eventRunoff(curvNum_bare, maxPrecip10, procGDB, "bare")
+   pyrList.append(runoffDepth_bare)
    print("Barren land runoff raster complete.")
 
    
    ### Calculate Soil Loss Potential, Runoff Potential, and Soil Sensitivity Scores ###
-   print("Creating score rasters for soil loss, runoff, and soil sensitivity...")
-   calcSoilSensScore(soilLoss_bare, runoffDepth_bare, procGDB, MaskNoWater)
    # --> Function outputs in procGDB are soilLoss_Score, runoff_Score, and soilSens_Score
    soilLossScore = procGDB + os.sep + "soilLoss_Score"
    runoffScore = procGDB + os.sep + "runoff_Score"
    SoilSensScore = procGDB + os.sep + "soilSens_Score"
-   print("Building pyramids...")
-   for ras in [soilLossScore, runoffScore, SoilSensScore]:
-      arcpy.management.BuildPyramids(ras)
+   if not isDone(SoilSensScore, rerun):
+      print("Creating score rasters for soil loss, runoff, and soil sensitivity...")
+      calcSoilSensScore(soilLoss_bare, runoffDepth_bare, procGDB, MaskNoWater)
+   pyrList.extend([soilLossScore, runoffScore, SoilSensScore])
    print("Soil score rasters complete.")
    
    
@@ -192,24 +221,31 @@ def main():
    FlowLength = procGDB + os.sep + "overlandFlowLength"
    # NOTE: this function can take many hours to run, as it runs a Flow Length analysis for each hydrologic unit,
    # and then mosaics the outputs.
-   calcFlowLength(NHDPlus_rastPath, HUC4List, extent=clpShp, out_GDB=procGDB, out_FlowLength=FlowLength)
+   if not isDone(FlowLength, rerun):
+      calcFlowLength(NHDPlus_rastPath, HUC4List, extent=clpShp, out_GDB=procGDB, out_FlowLength=FlowLength)
+   pyrList.append(FlowLength)
    print("Flow length raster complete.")
 
    ## Prepare the headwaters raster
    print("Creating headwaters raster...")
    Headwaters = procGDB + os.sep + "Hdwtrs"
-   makeHdwtrsIndicator(FlowLines, Catchments, clpShp, MaskNoWater, Headwaters)
-   print("Building pyramids...")
-   arcpy.management.BuildPyramids(Headwaters)
+   # The catchments are rasterized (by object ID) only once; later runs reuse the raster and just look up the headwaters flags for its object IDs.
+   # They are reprojected first if needed, and the reprojected copy is kept, so the object IDs in the raster match the features used to look up the flags.
+   CatchPrj = procGDB + os.sep + "CatchmentsPrj"
+   CatchZones = procGDB + os.sep + "CatchZones"
+   if not isDone(CatchZones, rerun):
+      print("Rasterizing catchments...")
+      CatchPrj = ProjectToMatch_vec(Catchments, MaskNoWater, CatchPrj, copy = 0)
+      PolyToRaster(CatchPrj, arcpy.Describe(CatchPrj).OIDFieldName, MaskNoWater, CatchZones)
+   elif not arcpy.Exists(CatchPrj):
+      CatchPrj = Catchments
+   if not isDone(Headwaters, rerun):
+      makeHdwtrsIndicator(FlowLines, CatchPrj, clpShp, MaskNoWater, Headwaters, in_CatchRaster = CatchZones)
+   pyrList.append(Headwaters)
    print("Headwaters raster complete.")
    
-   ## Calculate Overland Flow score ##
-   print("Creating score raster for overland flow...")
+   ## The Overland Flow score is calculated together with the Landscape Position and Impact scores, below. (Alternatively, use calcFlowScore to calculate it on its own.)
    FlowScore = procGDB + os.sep + "FlowScore"
-   calcFlowScore(FlowLength, FlowScore, Headwaters)
-   print("Building pyramids...")
-   arcpy.management.BuildPyramids(FlowScore)
-   print("Flow score complete.")
    
    
    ### Karst procedures ###
@@ -218,44 +254,32 @@ def main():
    # --> Manual operation required: Prior to running density scoring function, make sure the sinkhole data are "clean", i.e., no overlaps/duplicates. There must also be a field representing the sinkhole area in desired units (i.e., square meters).
    
    ## Calculate sinkhole density
-   print("Calculating sinkhole density...")
-   calcSinkDensity(in_SinkPolys, fld_Area, procMask, procGDB, searchRadius = 5000)
-   print("Density calculation complete.")
-   # --> Function outputs in procGDB are sinkPoints, sinkPoints_prj, and sinkDens
-   sinkPoints = procGDB + os.sep + "sinkPoints"
-   sinkPoints_prj = procGDB + os.sep + "sinkPoints_prj"
+   # --> Function output in procGDB is sinkDens (plus sinkPoints, if keepIntermediates = True)
    sinkDens = procGDB + os.sep + "sinkDens"
+   if not isDone(sinkDens, rerun):
+      print("Calculating sinkhole density...")
+      calcSinkDensity(in_SinkPolys, fld_Area, procMask, procGDB, searchRadius = 5000)
+   print("Density calculation complete.")
    
    ## Calculate Karst Prevalence Score
-   print("Creating score raster for karst prevalence...")
-   calcKarstScore(KarstPolys, procMask, MaskNoWater, procGDB, sinkDens, minDist = 100, maxDist = 5000)
-   # --> Function outputs in procGDB are karst_Raster, karst_eDist, karst_distScore, karst_densScore, karst_Score
-   karst_Raster = procGDB + os.sep + "karst_Raster"
-   karst_eDist = procGDB + os.sep + "karst_eDist" 
-   karst_distScore = procGDB + os.sep + "karst_distScore" 
-   karst_densScore = procGDB + os.sep + "karst_densScore"
+   # --> Function output in procGDB is KarstScore (plus karst_Raster, karst_eDist, karst_distScore, and karst_densScore, if keepIntermediates = True)
    KarstScore = procGDB + os.sep + "KarstScore" 
-   print("Building pyramids...")
-   arcpy.management.BuildPyramids(KarstScore)
+   if not isDone(KarstScore, rerun):
+      print("Creating score raster for karst prevalence...")
+      calcKarstScore(KarstPolys, procMask, MaskNoWater, procGDB, sinkDens, minDist = 100, maxDist = 5000)
+   pyrList.append(KarstScore)
    print("Karst score complete.")
    
    
-   ### Landscape Position Score ###
-   print("Creating score raster for landscape position...")
+   ### Overland Flow, Landscape Position, and Potential Impact Scores ###
+   # These are calculated in a single pass. To calculate them separately, use calcFlowScore, calcPositionScore, and calcImpactScore.
+   print("Creating score rasters for overland flow, landscape position, and potential impact...")
    PositionScore = procGDB + os.sep + "PositionScore"
-   calcPositionScore(FlowScore, KarstScore, PositionScore)
-   print("Building pyramids...")
-   arcpy.management.BuildPyramids(PositionScore)
-   print("Landscape position score complete.")
-   
-   
-   ### Potential Impact Score ###
-   print("Creating score raster for potential impact...")
    ImpactScore = procGDB + os.sep + "ImpactScore"
-   calcImpactScore(PositionScore, SoilSensScore, ImpactScore)
-   print("Building pyramids...")
-   arcpy.management.BuildPyramids(ImpactScore)
-   print("Impact score complete.")
+   if not isDone(ImpactScore, rerun):
+      calcFlowPositionImpact(FlowLength, Headwaters, KarstScore, SoilSensScore, FlowScore, PositionScore, ImpactScore)
+   pyrList.extend([FlowScore, PositionScore, ImpactScore])
+   print("Flow, landscape position, and impact scores complete.")
    
    
    ### Finalize TIF Products ###
@@ -266,6 +290,13 @@ def main():
    for ras in procList:
       finalize_gdbRas2Tif(ras, mask, outPath)
    
+   
+   ### Pyramids for processed rasters (optional, for viewing) ###
+   if buildPyramids == 1:
+      for ras in pyrList:
+         print("Building pyramids for %s..." %os.path.basename(ras))
+         arcpy.management.BuildPyramids(ras)
+   
 if __name__ == "__main__":
    main()
    